@@ -1,7 +1,7 @@
 
 import { IncomingMessage, ServerResponse } from 'http';
 import { Game, GameSetup, Country, RequestAction, Query, PlayingMode, GameState, Language, parseCountry, defaultLanguage, PlayerIndex, GameSession, DifficultyLevel, Settings, settingsFromQuery, defaultSettings } from "@/src/game.types"
-import { randomChoice } from "@/src/util";
+import { weightedChoice } from "@/src/util";
 import _ from "lodash";
 // import { promises as fs } from 'fs';
 var fs = require('fs').promises;
@@ -153,9 +153,84 @@ function checkWinner(game: Game) {
 }
 
 
+type GameBankShard = {
+  file: string,
+  difficultyLevel: DifficultyLevel | null,  // null: shard contains all difficulty levels
+  count: number,
+  levels: { [level: string]: number }
+}
+type GameBankManifest = {
+  format: "ndjson",
+  count: number,
+  shards: GameBankShard[]
+}
+
+type CompactGameBank = {
+  format: "compact",
+  count: number,
+  setkeys: [string, any][],  // [category key, value]
+  cells: [number, number, string[], string[]][],  // [setkey id 1, setkey id 2 (larger), solutions, alternative solutions]
+  games: {
+    size: number[],
+    rows: number[][],
+    cols: number[][],
+    data: { [field: string]: any[] }
+  }
+}
+type GameBank = {
+  count: number,
+  get: (k: number) => Omit<GameSetup, "language">
+}
+
+/**
+ * Expands game k of a compact game bank (which references shared setkey and cell tables) to a game setup.
+ */
+function expandCompactGame(bank: CompactGameBank, cells: Map<string, [string[], string[]]>, k: number) {
+  const { size, rows, cols, data } = bank.games
+  const gameCells = rows[k].map(row => cols[k].map(col => cells.get(`${Math.min(row, col)},${Math.max(row, col)}`) ?? [[], []]))
+  return {
+    size: size[k],
+    solutions: gameCells.map(row => row.map(([contents, altContents]) => contents)),
+    alternativeSolutions: gameCells.map(row => row.map(([contents, altContents]) => altContents)),
+    rows: rows[k].map(i => ({ category: bank.setkeys[i][0], value: bank.setkeys[i][1] })),
+    cols: cols[k].map(i => ({ category: bank.setkeys[i][0], value: bank.setkeys[i][1] })),
+    data: _.omitBy(_.mapValues(data, values => values[k]), _.isNil)
+  } as Omit<GameSetup, "language">
+}
+
+/**
+ * Reads a game bank: a JSON array file, a compact bank file, or a directory of NDJSON shards with a manifest.
+ * For sharded banks, only one shard is read (chosen proportional to its number of games of the given difficulty).
+ * Games of compact banks are only expanded when accessed.
+ */
+async function readGameBank(bankPath: string, difficulty: DifficultyLevel | null): Promise<GameBank> {
+  const stat = await fs.stat(bankPath)
+  if (!stat.isDirectory()) {
+    const data = JSON.parse(await fs.readFile(bankPath))
+    if (Array.isArray(data)) {
+      return { count: data.length, get: k => data[k] }
+    }
+    const bank = data as CompactGameBank
+    const cells = new Map(bank.cells.map(([id1, id2, contents, altContents]) => [`${id1},${id2}`, [contents, altContents]] as [string, [string[], string[]]]))
+    return { count: bank.count, get: k => expandCompactGame(bank, cells, k) }
+  }
+  const manifest = JSON.parse(await fs.readFile(path.join(bankPath, "manifest.json"))) as GameBankManifest
+  const weights = manifest.shards.map(shard => difficulty ? (shard.levels[difficulty] ?? 0) : shard.count)
+  const shard = weightedChoice(manifest.shards, weights)
+  if (!shard) {
+    return { count: 0, get: k => ({}) as Omit<GameSetup, "language"> }
+  }
+  const file = path.join(bankPath, shard.file)
+  console.log(`Read games from shard ${file}`);
+  const data: string = await fs.readFile(file, "utf8")
+  const gameSetups = data.split("\n").filter(line => line.trim()).map(line => JSON.parse(line))
+  return { count: gameSetups.length, get: k => gameSetups[k] }
+}
+
 async function chooseGameSetup(
   language: Language,
-  filter: ((gameSetup: GameSetup) => boolean) | null = null
+  filter: ((gameSetup: GameSetup) => boolean) | null = null,
+  difficulty: DifficultyLevel | null = null
 ): Promise<GameSetup | null> {
 
   // const allFiles = await fs.readdir("./data")
@@ -170,22 +245,18 @@ async function chooseGameSetup(
       return null
     }
     const file = path.join(dir, _.max(files) ?? "")
-    console.log(`Read games from file ${file}`);
-    const data = await fs.readFile(file)
-    let gameSetups = JSON.parse(data).map((props: Omit<GameSetup, "props">) => ({
-      ...props,
-      language: language
-    })) as GameSetup[]
-
-    if (filter) {
-      gameSetups = gameSetups.filter(filter)
-    }
-    // console.log(`Choose game setup (out of ${gameSetups.length})`)
-    const gameSetup =  randomChoice(gameSetups)
-    if (!gameSetup) {
-      return null
+    console.log(`Read games from ${file}`);
+    const bank = await readGameBank(file, difficulty)
+
+    // Visit the games in random order and return the first one passing the filter
+    // console.log(`Choose game setup (out of ${bank.count})`)
+    for (const k of _.shuffle(_.range(bank.count))) {
+      const gameSetup = { ...bank.get(k), language: language } as GameSetup
+      if (!filter || filter(gameSetup)) {
+        return gameSetup
+      }
     }
-    return gameSetup
+    return null
 
   } catch (err) {
     return null
@@ -209,7 +280,8 @@ async function createGame(
     language,
     gameSetup => {
       return gameSetup.data.difficultyLevel == difficulty
-    }
+    },
+    difficulty
   )
   if (!gameSetup) {
     return null
@@ -0,0 +1,360 @@
+import json
+import os
+import shutil
+import numpy as np
+from difficulty import DifficultyLevel
+
+
+MANIFEST_FILE = "manifest.json"
+
+
+def temp_path(path: str) -> str:
+    """ Hidden sibling of a bank file or directory, which it is written to before being renamed on success.
+    The game API reads the newest (maximum) name of a games directory, which a hidden name never is. """
+    return os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+
+
+def remove_path(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class ShardedGameWriter:
+    """ Streams games to a directory of NDJSON shards (one game JSON per line) plus a manifest.
+    A new shard is started every shard_size games. With by_level, every difficulty level gets its own shards.
+    The manifest lists the shards with their number of games per difficulty level, so readers only parse the shard they need.
+    The shards are written to a temporary directory, which is renamed to *directory* with the manifest on close(). """
+
+    def __init__(self, directory: str, shard_size: int = 1000, by_level: bool = False, prefix: str = "games"):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.by_level = by_level
+        self.prefix = prefix
+        self.shards = []  # manifest entries
+        self._open = {}  # level (or None) -> (file handle, manifest entry)
+        self.count = 0
+        self.temp_directory = temp_path(directory)
+        remove_path(self.temp_directory)
+        os.makedirs(self.temp_directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # An incomplete bank (e.g. interrupted generation) is discarded instead of being saved with a manifest
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def _shard(self, level):
+        """ Returns the open shard for the level, rolling over to a new shard when the current one is full """
+        key = level if self.by_level else None
+        if key in self._open and self._open[key][1]["count"] >= self.shard_size:
+            self._open.pop(key)[0].close()
+        if key not in self._open:
+            num = len([s for s in self.shards if s["difficultyLevel"] == key])
+            file = f"{self.prefix}-{key}-{num:04d}.ndjson" if key is not None else f"{self.prefix}-{num:04d}.ndjson"
+            entry = {"file": file, "difficultyLevel": key, "count": 0, "levels": {}}
+            self.shards.append(entry)
+            self._open[key] = (open(os.path.join(self.temp_directory, file), mode="w", encoding="utf-8"), entry)
+        return self._open[key]
+
+    def write(self, game):
+        data = game.to_json()
+        level = data["data"].get("difficultyLevel")
+        f, entry = self._shard(level)
+        f.write(json.dumps(data) + "\n")
+        entry["count"] += 1
+        entry["levels"][level] = entry["levels"].get(level, 0) + 1
+        self.count += 1
+
+    def write_all(self, games):
+        for game in games:
+            self.write(game)
+        return self.count
+
+    def _close_shards(self):
+        for f, entry in self._open.values():
+            f.close()
+        self._open = {}
+
+    def close(self):
+        self._close_shards()
+        with open(os.path.join(self.temp_directory, MANIFEST_FILE), mode="w", encoding="utf-8") as f:
+            json.dump({"format": "ndjson", "count": self.count, "shardSize": self.shard_size, "byLevel": self.by_level, "shards": self.shards}, f, indent=2)
+        os.replace(self.temp_directory, self.directory)
+
+    def abort(self):
+        self._close_shards()
+        remove_path(self.temp_directory)
+
+
+class CompactGameWriter:
+    """ Writes games into a compact bank file (format "compact"). Setkeys and the distinct cells (solutions and alternative
+    solutions) are stored once per bank, every game only holds its row and column setkey ids and its data.
+    The games are stored column-wise (size, rows, cols and one list per data field). Only these small records are kept
+    in memory until the writer is closed, the Game instances themselves are not. The file is only written by close(),
+    to a temporary name first. """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.setkey_ids = {}  # (category key, value) -> id
+        self.cells = {}  # (id1, id2) with id1 < id2 -> (solutions, alternative solutions)
+        self.columns = {"size": [], "rows": [], "cols": []}
+        self.data_columns = {}  # data field -> values (None where a game has no such field)
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+
+    def write(self, game):
+        ids = [self.setkey_ids.setdefault((cat.key, value), len(self.setkey_ids)) for cat, value in game.rows + game.cols]
+        row_ids, col_ids = ids[:len(game.rows)], ids[len(game.rows):]
+        for i, row in enumerate(row_ids):
+            for j, col in enumerate(col_ids):
+                key = (min(row, col), max(row, col))
+                if key not in self.cells:
+                    self.cells[key] = (list(game.solutions[i][j]), list(game.alt_solutions[i][j]))
+        data = game.to_compact_json(self.setkey_ids)
+        for field in ("size", "rows", "cols"):
+            self.columns[field].append(data[field])
+        for field in data["data"].keys() - self.data_columns.keys():
+            self.data_columns[field] = [None] * self.count
+        for field, values in self.data_columns.items():
+            values.append(data["data"].get(field))
+        self.count += 1
+
+    def write_all(self, games):
+        for game in games:
+            self.write(game)
+        return self.count
+
+    def close(self):
+        setkeys = sorted(self.setkey_ids.items(), key=lambda item: item[1])
+        tmp_path = temp_path(self.path)
+        try:
+            with open(tmp_path, mode="w", encoding="utf-8") as f:
+                json.dump({"format": "compact", "version": 1, "count": self.count,
+                           "setkeys": [[key, value] for (key, value), i in setkeys],
+                           "cells": [[id1, id2, contents, alt_contents] for (id1, id2), (contents, alt_contents) in self.cells.items()],
+                           "games": {**self.columns, "data": self.data_columns}}, f, separators=(",", ":"))
+        except BaseException:
+            remove_path(tmp_path)
+            raise
+        os.replace(tmp_path, self.path)
+
+
+class CompactGameBank:
+    """ Loader of a compact bank file. Games are expanded to the regular game JSON (Game.to_json) on demand. """
+
+    def __init__(self, path: str):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("format") != "compact":
+            raise ValueError(f"{path} is not a compact game bank")
+        self.setkeys = [{"category": key, "value": value} for key, value in data["setkeys"]]
+        self.cells = {(id1, id2): (contents, alt_contents) for id1, id2, contents, alt_contents in data["cells"]}
+        self.games = data["games"]
+        self.count = data["count"]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, k) -> dict:
+        """ Expands game k to the regular game JSON """
+        games = self.games
+        cells = [[self.cells[min(row, col), max(row, col)] for col in games["cols"][k]] for row in games["rows"][k]]
+        return {
+            "size": games["size"][k],
+            "solutions": [[list(contents) for contents, alt_contents in row] for row in cells],
+            "alternativeSolutions": [[list(alt_contents) for contents, alt_contents in row] for row in cells],
+            "rows": [self.setkeys[i] for i in games["rows"][k]],
+            "cols": [self.setkeys[i] for i in games["cols"][k]],
+            "data": {field: values[k] for field, values in games["data"].items() if values[k] is not None}
+        }
+
+    def __iter__(self):
+        return (self[k] for k in range(len(self)))
+
+    def indices(self, level=None):
+        """ Positions of the games (optionally only of one difficulty level) """
+        levels = self.games["data"].get("difficultyLevel", [None] * len(self))
+        return [k for k in range(len(self)) if level is None or levels[k] == str(level)]
+
+
+def write_json_array(games, path: str) -> int:
+    """ Streams games into one JSON array file. Returns the number of games written.
+    The games are streamed to a temporary file, which only replaces *path* once all games are written. """
+    count = 0
+    tmp_path = temp_path(path)
+    try:
+        with open(tmp_path, mode="w", encoding="utf-8") as f:
+            f.write("[")
+            for game in games:
+                f.write(("," if count else "") + json.dumps(game.to_json()))
+                count += 1
+            f.write("]")
+    except BaseException:
+        remove_path(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+    return count
+
+
+def read_manifest(directory: str) -> dict:
+    with open(os.path.join(directory, MANIFEST_FILE), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def iter_sharded_games(directory: str, level=None):
+    """ Yields the game JSON dicts of a sharded bank (optionally only those of one difficulty level) """
+    level = str(level) if level is not None else None
+    for shard in read_manifest(directory)["shards"]:
+        if level is not None and not shard["levels"].get(level):
+            continue
+        with open(os.path.join(directory, shard["file"]), encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    data = json.loads(line)
+                    if level is None or data["data"].get("difficultyLevel") == level:
+                        yield data
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Memory-mapped game index
+
+INDEX_LEVELS = [str(level) for level in DifficultyLevel]
+
+
+def index_dtype(size: int) -> np.dtype:
+    """ Fixed-width record of one game: row/col setkey ids, difficulty level id (-1: none) and cell difficulties """
+    return np.dtype([("rows", np.int16, (size,)), ("cols", np.int16, (size,)), ("level", np.int8),
+                     ("avg_cell_difficulty", np.float32), ("max_cell_difficulty", np.float32)])
+
+
+class GameIndexWriter:
+    """ Writes games as fixed-width records into <directory>/index.npy, ordered by difficulty level,
+    plus <directory>/index.json with the setkey and cell tables and the record range of every level.
+    Only the records are kept in memory until the writer is closed. Both files are written by close(), into a temporary
+    directory which is then renamed to *directory*. """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.setkey_ids = {}  # (category key, value) -> id
+        self.cells = {}  # (id1, id2) with id1 < id2 -> (solutions, alternative solutions)
+        self.records = {level: [] for level in INDEX_LEVELS + [None]}
+        self.size = None
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+
+    def write(self, game):
+        if self.size is None:
+            self.size = game.size
+        if game.size != self.size:
+            raise ValueError(f"All games of an index must have the same size ({game.size} != {self.size})")
+        ids = [self.setkey_ids.setdefault((cat.key, value), len(self.setkey_ids)) for cat, value in game.rows + game.cols]
+        row_ids, col_ids = ids[:self.size], ids[self.size:]
+        for i, row in enumerate(row_ids):
+            for j, col in enumerate(col_ids):
+                key = (min(row, col), max(row, col))
+                if key not in self.cells:
+                    self.cells[key] = (list(game.solutions[i][j]), list(game.alt_solutions[i][j]))
+        level = game.data.get("difficulty_level")
+        level = level if level in INDEX_LEVELS else None
+        self.records[level].append((row_ids, col_ids, INDEX_LEVELS.index(level) if level is not None else -1,
+                                    game.data.get("avg_cell_difficulty", np.nan), game.data.get("max_cell_difficulty", np.nan)))
+        self.count += 1
+
+    def write_all(self, games):
+        for game in games:
+            self.write(game)
+        return self.count
+
+    def close(self):
+        if len(self.setkey_ids) > np.iinfo(np.int16).max:
+            raise ValueError(f"Too many setkeys for the index ({len(self.setkey_ids)})")
+        records = np.array([record for level in self.records for record in self.records[level]], dtype=index_dtype(self.size or 0))
+        tmp_directory = temp_path(self.directory)
+        remove_path(tmp_directory)
+        os.makedirs(tmp_directory)
+        try:
+            self._write(tmp_directory, records)
+        except BaseException:
+            remove_path(tmp_directory)
+            raise
+        os.replace(tmp_directory, self.directory)
+
+    def _write(self, directory, records):
+        np.save(os.path.join(directory, "index.npy"), records)
+
+        levels, start = {}, 0
+        for level in INDEX_LEVELS:
+            levels[level] = [start, start + len(self.records[level])]
+            start += len(self.records[level])
+        setkeys = sorted(self.setkey_ids.items(), key=lambda item: item[1])
+        with open(os.path.join(directory, "index.json"), mode="w", encoding="utf-8") as f:
+            json.dump({"format": "index", "version": 1, "count": self.count, "size": self.size, "levels": levels,
+                       "setkeys": [[key, value] for (key, value), i in setkeys],
+                       "cells": [[id1, id2, contents, alt_contents] for (id1, id2), (contents, alt_contents) in self.cells.items()]},
+                      f, separators=(",", ":"))
+
+
+class GameIndex:
+    """ Reader of a game index written by GameIndexWriter. The records are memory-mapped,
+    so game k or a random game of a difficulty level is fetched in O(1) without loading the whole bank. """
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, "index.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.records = np.load(os.path.join(directory, "index.npy"), mmap_mode="r")
+        self.size = meta["size"]
+        self.levels = {level: tuple(bounds) for level, bounds in meta["levels"].items()}  # level -> [start, end) of its records
+        self.setkeys = [{"category": key, "value": value} for key, value in meta["setkeys"]]
+        self.cells = {(id1, id2): (contents, alt_contents) for id1, id2, contents, alt_contents in meta["cells"]}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, k) -> dict:
+        """ Expands record k to the regular game JSON """
+        record = self.records[k]
+        rows, cols = record["rows"].tolist(), record["cols"].tolist()
+        cells = [[self.cells[min(row, col), max(row, col)] for col in cols] for row in rows]
+        data = {"maxCellDifficulty": float(record["max_cell_difficulty"]), "avgCellDifficulty": float(record["avg_cell_difficulty"])}
+        if record["level"] >= 0:
+            data["difficultyLevel"] = INDEX_LEVELS[record["level"]]
+        return {
+            "size": self.size,
+            "solutions": [[list(contents) for contents, alt_contents in row] for row in cells],
+            "alternativeSolutions": [[list(alt_contents) for contents, alt_contents in row] for row in cells],
+            "rows": [self.setkeys[i] for i in rows],
+            "cols": [self.setkeys[i] for i in cols],
+            "data": data
+        }
+
+    def count(self, level=None) -> int:
+        if level is None:
+            return len(self)
+        start, end = self.levels[str(level)]
+        return end - start
+
+    def random(self, level=None, rng=None) -> dict:
+        """ Random game (optionally of the given difficulty level) """
+        rng = rng if rng is not None else np.random.default_rng()
+        start, end = self.levels[str(level)] if level is not None else (0, len(self))
+        if end <= start:
+            return None
+        return self[int(rng.integers(start, end))]
@@ -0,0 +1,256 @@
+"""
+Benchmark suite of the preprocessing pipeline, based on the checked-in country data (public/data/countries).
+
+Measures Preprocessor construction (with and without cache), GameGenerator throughput (games/sec, both selection modes
+and per field size), DifficultyEstimator setup, compute_game_difficulties and save_games, including the peak memory of
+each step. Results are written as JSON and compared against a stored baseline, flagging regressions.
+
+Throughput targets (games/sec of a single process, see THROUGHPUT_TARGETS): 3x3 >= 420, 4x4 >= 340, 5x5 >= 130.
+Boards larger than 3x3 backtrack on dead ends instead of restarting (GameGenerator max_backtracks), which keeps
+the restart rate of 4x4 and 5x5 boards low. The targets are the backtracking throughput measured on the reference
+machine (single core) minus ~15%, so restart-only generation of 5x5 boards (~110-125 games/sec) falls below its
+target there. As absolute numbers depend on the hardware, sizes below their target are only reported as warnings
+(unless --enforce-targets is set). Regressions against the baseline and results without a baseline entry fail the run.
+
+Usage:
+    python benchmark.py                           # run and compare against benchmarks/baseline.json
+    python benchmark.py --save-baseline           # run and store the results as new baseline
+    python benchmark.py --games 500 --languages en --output results.json
+    python benchmark.py --field-sizes 4 5 --no-memory
+    python benchmark.py --enforce-targets         # also fail if a field size is below its throughput target
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from utils import *
+
+# Ensure we're running in the right directory
+chdir_this_file()
+
+from preprocessing import Preprocessor
+from generator import Constraint
+from difficulty import DifficultyEstimator
+
+
+BASELINE_PATH = "benchmarks/baseline.json"
+SEED = 0
+FIELD_SIZES = [3, 4, 5]
+THROUGHPUT_TARGETS = {3: 420, 4: 340, 5: 130}  # field size -> games/sec
+MIN_TIME_DELTA = 0.1  # seconds, slowdowns below are timer noise
+CATEGORY_PROBS = {
+    'continent': 4,
+    'starting_letter': 3,
+    'ending_letter': 1.5,
+    'capital_starting_letter': 2,
+    'capital_ending_letter': .5,
+    'flag_colors': 3,
+    'landlocked': 2,
+    'island': 2,
+    'top_20_population': 2.5,
+    'bottom_20_population': 2,
+    'top_20_area': 2.5,
+    'bottom_20_area': 2,
+    'elevation_sup5k': 2.5,
+    'elevation_sub1k': 2,
+}
+CONSTRAINTS = lambda countries: [
+    Constraint.category_at_most("capital_ending_letter", 1),
+    Constraint.category_at_most("capital_starting_letter", 1),
+    Constraint.category_at_most("ending_letter", 1),
+    *Constraint.solutions_at_most(countries.iso.tolist(), 3)
+]
+
+
+def load_countries(language):
+    return pd.read_json(f"../../public/data/countries/countries-{language.lower()}.json", encoding="utf8")
+
+
+def measure(func, memory=True):
+    """ Runs func (quietly) and returns its result, the elapsed time and the peak memory (MB) """
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        peak = None
+        if memory:
+            # Separate run for the memory peak, as tracing slows down the timed run
+            tracemalloc.start()
+            func()
+            peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+    return result, elapsed, peak
+
+
+class Benchmark:
+    def __init__(self, languages, num_games, generator_games, memory=True, field_sizes=FIELD_SIZES):
+        self.languages = languages
+        self.field_sizes = field_sizes
+        self.num_games = num_games  # games to score and save
+        self.generator_games = generator_games  # games to measure the generator throughput
+        self.memory = memory
+        self.results = {}
+
+    def record(self, name, elapsed, peak, **info):
+        self.results[name] = {"time": elapsed, "peak_memory_mb": peak, **info}
+        details = ", ".join(f"{k}={v:.1f}" if isinstance(v, float) else f"{k}={v}" for k, v in info.items())
+        print(f"{name:<45} {elapsed:8.3f}s" + (f" {peak:8.1f} MB" if peak is not None else "") + (f"  ({details})" if details else ""))
+
+    def run(self):
+        for language in self.languages:
+            countries = load_countries(language)
+
+            preprocessor, elapsed, peak = measure(lambda: Preprocessor(countries=countries.copy(), language=language, cache_dir=None), self.memory)
+            self.record(f"{language}/preprocessor", elapsed, peak, sets=len(preprocessor.setkeys), cells=len(preprocessor.cells))
+
+            with tempfile.TemporaryDirectory() as cache_dir:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    Preprocessor(countries=countries.copy(), language=language, cache_dir=cache_dir)
+                _, elapsed, peak = measure(lambda: Preprocessor(countries=countries.copy(), language=language, cache_dir=cache_dir), self.memory)
+            self.record(f"{language}/preprocessor_cached", elapsed, peak)
+
+            for mode in ["shuffle_setkeys", "shuffle_categories"]:
+                def generate():
+                    generator = preprocessor.get_generator(CONSTRAINTS(countries), CATEGORY_PROBS, seed=SEED, selection_mode=mode)
+                    return list(generator.sample_games(n=self.generator_games, progress_bar=False))
+                games, elapsed, peak = measure(generate, self.memory)
+                self.record(f"{language}/generator/{mode}", elapsed, peak, games=len(games), games_per_sec=len(games) / elapsed)
+
+            for size in self.field_sizes:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    sized = preprocessor if size == preprocessor.field_size else Preprocessor(countries=countries.copy(), language=language, field_size=size, cache_dir=None)
+                def generate():
+                    generator = sized.get_generator(CONSTRAINTS(countries), CATEGORY_PROBS, seed=SEED)
+                    return list(generator.sample_games(n=self.generator_games, progress_bar=False)), generator.stats.summary()
+                (games, summary), elapsed, peak = measure(generate, self.memory)
+                self.record(f"{language}/generator/size_{size}", elapsed, peak, field_size=size, games=len(games),
+                            games_per_sec=len(games) / elapsed, avg_tries=summary["avg_tries"])
+
+            estimator, elapsed, peak = measure(lambda: DifficultyEstimator(preprocessor), self.memory)
+            self.record(f"{language}/difficulty_estimator", elapsed, peak)
+
+            generator = preprocessor.get_generator(CONSTRAINTS(countries), CATEGORY_PROBS, seed=SEED)
+            with contextlib.redirect_stdout(io.StringIO()):
+                games = list(generator.sample_games(n=self.num_games, progress_bar=False))
+            _, elapsed, peak = measure(lambda: estimator.compute_game_difficulties(games), self.memory)
+            self.record(f"{language}/compute_game_difficulties", elapsed, peak, games=len(games))
+
+            with tempfile.TemporaryDirectory() as data_dir:
+                _, elapsed, peak = measure(lambda: preprocessor.save_games(games, name="benchmark", data_dir=data_dir), self.memory)
+            self.record(f"{language}/save_games", elapsed, peak, games=len(games))
+
+        return self.results
+
+    def to_json(self):
+        return {
+            "meta": {
+                "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "pandas": pd.__version__,
+                "machine": platform.machine(),
+                "languages": self.languages,
+                "num_games": self.num_games,
+                "generator_games": self.generator_games,
+            },
+            "results": self.results
+        }
+
+
+def compare(results, baseline, tolerance, min_time_delta=MIN_TIME_DELTA):
+    """ Compares the results against the baseline. Returns the list of regressions (time or memory).
+    Time slowdowns of less than min_time_delta seconds are ignored, as sub-second steps are dominated by noise. """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ["time", "peak_memory_mb"]:
+            old, new = baseline[name].get(metric), result.get(metric)
+            if old is None or new is None or old <= 0:
+                continue
+            ratio = new / old
+            if metric == "time" and new - old < min_time_delta:
+                continue
+            if ratio > 1 + tolerance:
+                regressions.append((name, metric, old, new, ratio))
+    return regressions
+
+
+def missing_baseline(results, baseline):
+    """ Returns the names of the results without a baseline entry, which compare() cannot check """
+    return [name for name in results if name not in baseline]
+
+
+def check_targets(results):
+    """ Returns the per field size generator results below their throughput target """
+    shortfalls = []
+    for name, result in results.items():
+        target = THROUGHPUT_TARGETS.get(result.get("field_size"))
+        if target is not None and result["games_per_sec"] < target:
+            shortfalls.append((name, result["games_per_sec"], target))
+    return shortfalls
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the TicTacGlobe preprocessing pipeline")
+    parser.add_argument("--languages", nargs="+", default=["en", "de"])
+    parser.add_argument("--games", type=int, default=5000, help="number of games for difficulty scoring and saving")
+    parser.add_argument("--generator-games", type=int, default=500, help="number of games to measure the generator throughput")
+    parser.add_argument("--output", default=None, help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative slowdown flagged as regression")
+    parser.add_argument("--min-time-delta", type=float, default=MIN_TIME_DELTA, help="absolute slowdown (seconds) below which time is not flagged")
+    parser.add_argument("--no-memory", action="store_true", help="skip the (slower) peak memory measurement")
+    parser.add_argument("--enforce-targets", action="store_true", help="fail if a field size is below its throughput target")
+    parser.add_argument("--field-sizes", nargs="+", type=int, default=FIELD_SIZES, help="field sizes to measure the generator throughput")
+    args = parser.parse_args(argv)
+
+    benchmark = Benchmark(args.languages, args.games, args.generator_games, memory=not args.no_memory, field_sizes=args.field_sizes)
+    benchmark.run()
+    data = benchmark.to_json()
+
+    if args.output:
+        with open(args.output, mode="w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    shortfalls = check_targets(data["results"])
+    for name, games_per_sec, target in shortfalls:
+        print(f"{'BELOW TARGET' if args.enforce_targets else 'WARNING below target'} {name}: {games_per_sec:.1f} games/sec (target {target})")
+    failed_targets = bool(shortfalls) and args.enforce_targets
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, mode="w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline found at {args.baseline}")
+        return 1 if failed_targets else 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(data["results"], baseline, args.tolerance, args.min_time_delta)
+    for name, metric, old, new, ratio in regressions:
+        print(f"REGRESSION {name} {metric}: {old:.3f} -> {new:.3f} ({ratio:.2f}x)")
+    missing = missing_baseline(data["results"], baseline)
+    for name in missing:
+        print(f"NO BASELINE {name}: re-record {args.baseline} with --save-baseline")
+    if not regressions:
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 1 if regressions or missing or failed_targets else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
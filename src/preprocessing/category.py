@@ -1,23 +1,37 @@
 
 from functools import total_ordering
-from typing import Callable, List, Optional
+from typing import Callable, List
 import pandas as pd
 
 @total_ordering
 class Category:
-    def __init__(self, key: str, name: str, difficulty: float, col_dependencies: List[str], values: pd.Series, alt_values: Optional[pd.Series]):  # alt_values might be None
+    """ Values, alternative values and sets (sorted iso codes per value) are computed from the country data on construction.
+    Subclasses implement compute_values() and, if needed, compute_sets(). """
+
+    def __init__(self, df: pd.DataFrame, key: str, name: str, difficulty: float, col_dependencies: List[str]):
+        self.df = df
         self.key = key
         self.alt_key = key + "_alt"
         self.name = name
         self.difficulty = difficulty
         self.col_dependencies = col_dependencies
-        self.values = values
+
+        values, alt_values = self.compute_values()
         self.uses_alt_values = alt_values is not None
-        if not self.uses_alt_values:
-            alt_values = self.values.apply(lambda x: [])
-        self.alt_values = alt_values
-        self.sets = None
-        self.alt_sets = None
+        self.values = values
+        self.alt_values = alt_values if self.uses_alt_values else values.apply(lambda x: [])
+        self.sets, self.alt_sets = self.compute_sets()
+
+    def compute_values(self):
+        """ Returns the value of every country and its alternative values (lists), or None if there are no alternative values """
+        raise NotImplementedError()
+
+    def compute_sets(self):
+        """ Returns the sets and alternative sets: Series mapping each value to the sorted iso codes """
+        data = pd.DataFrame({"iso": self.df["iso"], self.key: self.values, self.alt_key: self.alt_values})
+        sets = data.groupby(by=self.key)["iso"].agg(sorted)
+        alt_sets = data.explode(column=self.alt_key).groupby(by=self.alt_key)["iso"].agg(sorted)
+        return sets, alt_sets
 
     def to_json(self):
         return {
@@ -45,22 +59,28 @@ class Category:
     def __hash__(self):
         return hash(self.key)
 
+    def __getstate__(self):
+        # Functions (e.g. lambda extractors) cannot be pickled and are left out, as is the country data
+        return {k: v for k, v in self.__dict__.items() if not callable(v) and k != "df"}
+
 @total_ordering
 class NominalCategory(Category):
     def __init__(self, df: pd.DataFrame, key: str, name: str, difficulty: float, col: str, extractor: Callable = None):
         self.col = col
         self.extractor = extractor
-        if extractor is None:
-            extractor = lambda x: x
+        self.alt_col = col + "_alt"
+        super().__init__(df, key, name, difficulty, [col])
+
+    def compute_values(self):
+        df, col, altcol = self.df, self.col, self.alt_col
+        extractor = self.extractor if self.extractor is not None else lambda x: x
         values = df[col].apply(extractor)
-        altcol = col + "_alt"
-        self.alt_col = altcol
         alt_values = None
         if self.alt_col in list(df.columns):
             data = pd.concat([df, values], axis=1)
             alt_values = data.apply(lambda row: list(sorted({extractor(x) for x in row[altcol]}.difference(row[col]))), axis=1)
 #                 print(alt_values[alt_values.apply(len) > 0])
-        super().__init__(key, name, difficulty, [col], values, alt_values)
+        return values, alt_values
         
     def __str__(self):
         return f"NominalCategory('{self.key}', {len(self.sets)} values)"
@@ -75,12 +95,23 @@ class NominalCategory(Category):
 @total_ordering
 class MultiNominalCategory(Category):
     def __init__(self, df: pd.DataFrame, key: str, name: str, difficulty: float, col: str):
+        self.col = col
+        super().__init__(df, key, name, difficulty, [col])
+
+    def compute_values(self):
+        df, col, altcol = self.df, self.col, self.col + "_alt"
         values = df[col].apply(set).apply(sorted).apply(list)
-        altcol = col + "_alt"
         alt_values = None
         if altcol in list(df.columns):
             alt_values = df.apply(lambda row: list(sorted(set(row[altcol]).difference(row[col]))), axis=1)
-        super().__init__(key, name, difficulty, [col], values, alt_values)
+        return values, alt_values
+
+    def compute_sets(self):
+        # every value of the list makes the country a member of the value's set
+        data = pd.DataFrame({"iso": self.df["iso"], self.key: self.values, self.alt_key: self.alt_values})
+        sets = data.explode(column=self.key).groupby(by=self.key)["iso"].agg(sorted)
+        alt_sets = data.explode(column=self.alt_key).groupby(by=self.alt_key)["iso"].agg(sorted)
+        return sets, alt_sets
         
     def __str__(self):
         return f"MultiNominalCategory('{self.key}', {len(self.sets)} values)"
@@ -93,6 +124,11 @@ class MultiNominalCategory(Category):
 
 
 class BooleanCategory(Category):
+    def compute_sets(self):
+        # only consider True values. The False group does not yield a catset
+        sets, alt_sets = super().compute_sets()
+        return sets[sets.index], alt_sets[alt_sets.index]
+
     def __str__(self):
         return f"BooleanCategory('{self.key}', {len(self.sets[True])}x True)"
 
@@ -100,12 +136,16 @@ class BooleanCategory(Category):
 @total_ordering
 class SimpleBooleanCategory(BooleanCategory):
     def __init__(self, df: pd.DataFrame, key: str, name: str, difficulty: float, col: str):
+        self.col = col
+        super().__init__(df, key, name, difficulty, [col])
+
+    def compute_values(self):
+        df, col, altcol = self.df, self.col, self.col + "_alt"
         values = df[col]
-        altcol = col + "_alt"
         alt_values = None
         if altcol in list(df.columns):
             alt_values = df.apply(lambda row: [not row[col]] if (not row[col]) in row[altcol] else [], axis=1)
-        super().__init__(key, name, difficulty, [col], values, alt_values)
+        return values, alt_values
         
     def __str__(self):
         return f"BooleanCategory('{self.key}', {len(self.sets[True])}x True)"
@@ -117,16 +157,12 @@ class ComparisonCategory(BooleanCategory):
     def __init__(self, df: pd.DataFrame, key: str, name: str, difficulty: float, col: str, bound: float, mode: str, or_equal: bool):
         # mode: "greater_than" | "less_than"
         if mode == "greater_than" and or_equal:
-            values = df[col] >= bound
             self.comparator = ">="
         elif mode == "greater_than" and not or_equal:
-            values = df[col] > bound
             self.comparator = ">"
         elif mode == "less_than" and or_equal:
-            values = df[col] <= bound
             self.comparator = "<="
         elif mode == "less_than" and not or_equal:
-            values = df[col] < bound
             self.comparator = "<"
         else:
             raise ValueError(f"ComparisonCategory received undefined parameters (mode={mode}, or_eqial={or_equal})")
@@ -134,7 +170,16 @@ class ComparisonCategory(BooleanCategory):
         self.col = col
         self.mode = mode
         self.bound = bound
-        super().__init__(key, name, difficulty, [col], values, alt_values=None)
+        self.or_equal = or_equal
+        super().__init__(df, key, name, difficulty, [col])
+
+    def compute_values(self):
+        x = self.df[self.col]
+        if self.mode == "greater_than":
+            values = x >= self.bound if self.or_equal else x > self.bound
+        else:
+            values = x <= self.bound if self.or_equal else x < self.bound
+        return values, None
         
     def __str__(self):
         return f"ComparisonCategory('{self.key}', {self.col} {self.comparator} {self.bound})"
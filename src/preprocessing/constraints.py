@@ -0,0 +1,249 @@
+import json
+import numpy as np
+from typing import Callable, List, Optional
+
+
+NO_BOUND = np.iinfo(np.int64).max // 2
+MODES = {"at_most": -1, "exactly": 0, "at_least": 1}
+
+
+def parse_mode(mode) -> int:
+    # mode: -1 / "at_most", 0 / "exactly", 1 / "at_least"
+    if isinstance(mode, str):
+        return MODES[mode]
+    if mode not in (-1, 0, 1):
+        raise ValueError(f"Unknown constraint mode {mode}")
+    return mode
+
+
+def mode_name(mode) -> str:
+    return {v: k for k, v in MODES.items()}[parse_mode(mode)]
+
+
+def bounds(num, mode):
+    mode = parse_mode(mode)
+    return (num if mode >= 0 else 0,
+            num if mode <= 0 else NO_BOUND)
+
+
+class CompiledConstraints:
+    """ Constraints compiled against the setkeys and cells of a GameGenerator.
+    Every constraint becomes a counter with lower and upper bounds. Each setkey and each cell adds a fixed vector
+    to the counters (setkey_vectors, cell_vectors). Counters are grouped into category and cell counters. """
+
+    def __init__(self, setkeys, cells):
+        # setkeys: list of (key, value). cells: list of (row, col, contents) in canonical orientation, indexed by cell id
+        self.setkeys = setkeys
+        self.cells = cells
+        self.countries = sorted({c for row, col, contents in cells for c in contents})
+        self._country_set = set(self.countries)
+        self.unsatisfiable = False  # e.g. a country without any cell is required
+
+        self._setkey_columns = []
+        self._cell_columns = []
+        self._lower = []
+        self._upper = []
+        self._is_category = []
+        self._labels = []
+        self._country_bounds = {}  # country -> [lower, upper]
+
+    def add_counter(self, setkey_match=None, cell_match=None, lower=0, upper=NO_BOUND, category=False, label=None):
+        """ Adds a counter over the setkeys (category counter) or the cells (cell counter) that match """
+        self._labels.append(label if label is not None else f"counter_{len(self._labels)}")
+        self._setkey_columns.append(np.zeros(len(self.setkeys), dtype=np.int64) if setkey_match is None else np.asarray(setkey_match, dtype=np.int64))
+        self._cell_columns.append(np.zeros(len(self.cells), dtype=np.int64) if cell_match is None else np.asarray(cell_match, dtype=np.int64))
+        self._lower.append(lower)
+        self._upper.append(upper)
+        self._is_category.append(category)
+
+    def bound_country(self, country, lower=0, upper=NO_BOUND):
+        """ Bounds the number of cells the country is a solution of. Multiple bounds of a country are intersected. """
+        if country not in self._country_set:
+            self.unsatisfiable |= lower > 0
+            return
+        current = self._country_bounds.setdefault(country, [0, NO_BOUND])
+        current[0] = max(current[0], lower)
+        current[1] = min(current[1], upper)
+
+    def finalize(self):
+        """ Builds the arrays used by the ConstraintTracker (counters: custom counters, then one per bounded country) """
+        countries = list(self._country_bounds.keys())
+        country_index = {c: i for i, c in enumerate(countries)}
+        cell_countries = np.zeros((len(self.cells), len(countries)), dtype=np.int64)
+        for i, (row, col, contents) in enumerate(self.cells):
+            cell_countries[i, [country_index[c] for c in contents if c in country_index]] = 1
+
+        n = len(self._lower)
+        self.setkey_vectors = np.column_stack(self._setkey_columns + [np.zeros((len(self.setkeys), len(countries)), dtype=np.int64)]) \
+            if n + len(countries) > 0 else np.zeros((len(self.setkeys), 0), dtype=np.int64)
+        self.cell_vectors = np.column_stack(self._cell_columns + [cell_countries]) \
+            if n + len(countries) > 0 else np.zeros((len(self.cells), 0), dtype=np.int64)
+        self.lower = np.array(self._lower + [self._country_bounds[c][0] for c in countries], dtype=np.int64)
+        self.upper = np.array(self._upper + [self._country_bounds[c][1] for c in countries], dtype=np.int64)
+        self.is_category_counter = np.array(self._is_category + [False] * len(countries), dtype=bool)
+        self.labels = self._labels + [f"solution_count:{c}" for c in countries]  # descriptions of the counters
+        self.bounded_countries = countries
+        return self
+
+
+class ConstraintSpec:
+    """ Declarative constraint. Compiles to counters (see CompiledConstraints) and can be serialized to JSON. """
+    type = None
+
+    def compile(self, compiled: CompiledConstraints):
+        raise NotImplementedError()
+
+    def to_json(self) -> dict:
+        raise NotImplementedError()
+
+    @staticmethod
+    def from_json(data: dict):
+        spec_types = {cls.type: cls for cls in (CategoryCountSpec, SolutionCountSpec, CellSizeSpec)}
+        if data.get("type") not in spec_types:
+            raise ValueError(f"Unknown constraint type '{data.get('type')}'")
+        return spec_types[data["type"]].from_json(data)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.to_json()})"
+
+
+class CategoryCountSpec(ConstraintSpec):
+    """ Number of rows and columns from the given categories (optionally restricted to certain values) """
+    type = "category_count"
+
+    def __init__(self, categories: List[str], num: int, mode="at_most", values: Optional[list] = None):
+        self.categories = [categories] if isinstance(categories, str) else list(categories)
+        self.num = num
+        self.mode = parse_mode(mode)
+        self.values = list(values) if values is not None else None
+
+    def compile(self, compiled: CompiledConstraints):
+        lower, upper = bounds(self.num, self.mode)
+        compiled.add_counter(setkey_match=[key in self.categories and (self.values is None or value in self.values) for key, value in compiled.setkeys],
+                             lower=lower, upper=upper, category=True,
+                             label=f"category_count:{','.join(self.categories)}:{mode_name(self.mode)}:{self.num}")
+
+    def to_json(self):
+        data = {"type": self.type, "categories": self.categories, "num": self.num, "mode": mode_name(self.mode)}
+        if self.values is not None:
+            data["values"] = self.values
+        return data
+
+    @staticmethod
+    def from_json(data):
+        return CategoryCountSpec(data["categories"], data["num"], data.get("mode", "at_most"), data.get("values"))
+
+
+class SolutionCountSpec(ConstraintSpec):
+    """ Number of cells each of the given countries (None: all countries) is a solution of """
+    type = "solution_count"
+
+    def __init__(self, countries: Optional[List[str]], num: int, mode="at_most"):
+        self.countries = list(countries) if countries is not None else None
+        self.num = num
+        self.mode = parse_mode(mode)
+
+    def compile(self, compiled: CompiledConstraints):
+        lower, upper = bounds(self.num, self.mode)
+        for country in (self.countries if self.countries is not None else compiled.countries):
+            compiled.bound_country(country, lower, upper)
+
+    def to_json(self):
+        return {"type": self.type, "countries": self.countries, "num": self.num, "mode": mode_name(self.mode)}
+
+    @staticmethod
+    def from_json(data):
+        return SolutionCountSpec(data.get("countries"), data["num"], data.get("mode", "at_most"))
+
+
+class CellSizeSpec(ConstraintSpec):
+    """ Minimum / maximum number of solutions of every cell in the game """
+    type = "cell_size"
+
+    def __init__(self, min: Optional[int] = None, max: Optional[int] = None):
+        self.min = min
+        self.max = max
+
+    def compile(self, compiled: CompiledConstraints):
+        sizes = np.array([len(contents) for row, col, contents in compiled.cells], dtype=np.int64)
+        violating = np.zeros(len(sizes), dtype=bool)
+        if self.min is not None:
+            violating |= sizes < self.min
+        if self.max is not None:
+            violating |= sizes > self.max
+        compiled.add_counter(cell_match=violating, upper=0, label=f"cell_size:{self.min}-{self.max}")
+
+    def to_json(self):
+        return {"type": self.type, "min": self.min, "max": self.max}
+
+    @staticmethod
+    def from_json(data):
+        return CellSizeSpec(data.get("min"), data.get("max"))
+
+
+class PropSpec(ConstraintSpec):
+    """ Wraps an arbitrary property function of a setkey (key, value) or a cell (row, col, solutions).
+    The property is evaluated once per setkey / cell at compile time. Not serializable. """
+    type = "prop"
+
+    def __init__(self, prop: Callable, num: int, mode, target: str):
+        self.prop = prop
+        self.num = num
+        self.mode = parse_mode(mode)
+        self.target = target  # "setkey" | "cell"
+
+    def compile(self, compiled: CompiledConstraints):
+        lower, upper = bounds(self.num, self.mode)
+        label = f"prop_{self.target}:{mode_name(self.mode)}:{self.num}"
+        if self.target == "setkey":
+            compiled.add_counter(setkey_match=[self.prop(key, value) for key, value in compiled.setkeys], lower=lower, upper=upper, category=True, label=label)
+        else:
+            compiled.add_counter(cell_match=[self.prop(row, col, contents) for row, col, contents in compiled.cells], lower=lower, upper=upper, label=label)
+
+    def to_json(self):
+        raise ValueError("Constraints defined by a property function cannot be serialized. Use a declarative constraint instead.")
+
+    def __repr__(self):
+        return f"PropSpec({self.target}, {mode_name(self.mode)} {self.num})"
+
+
+def to_spec(constraint) -> ConstraintSpec:
+    """ Returns the declarative form of a constraint (ConstraintSpec or Constraint from generator.py) """
+    return constraint if isinstance(constraint, ConstraintSpec) else constraint.to_spec()
+
+
+def compile_constraints(constraints, setkeys, cells) -> CompiledConstraints:
+    compiled = CompiledConstraints(setkeys, cells)
+    for constraint in constraints:
+        to_spec(constraint).compile(compiled)
+    return compiled.finalize()
+
+
+def constraints_to_json(constraints) -> list:
+    """ Serializes constraints. Per-country constraints with the same bounds are merged into one spec. """
+    data = []
+    merged = {}  # (num, mode) -> spec
+    for constraint in constraints:
+        spec = to_spec(constraint)
+        if isinstance(spec, SolutionCountSpec) and spec.countries is not None:
+            if (spec.num, spec.mode) in merged:
+                merged[(spec.num, spec.mode)].countries += spec.countries
+                continue
+            spec = SolutionCountSpec(spec.countries, spec.num, spec.mode)
+            merged[(spec.num, spec.mode)] = spec
+        data.append(spec)
+    return [spec.to_json() for spec in data]
+
+
+def constraints_from_json(data: list) -> List[ConstraintSpec]:
+    return [ConstraintSpec.from_json(item) for item in data]
+
+
+def save_constraints(constraints, path: str):
+    with open(path, mode="w", encoding="utf-8") as f:
+        json.dump(constraints_to_json(constraints), f, indent=2)
+
+
+def load_constraints(path: str) -> List[ConstraintSpec]:
+    with open(path, encoding="utf-8") as f:
+        return constraints_from_json(json.load(f))
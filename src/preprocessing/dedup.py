@@ -0,0 +1,160 @@
+"""
+Deduplication of generated games.
+
+A board and its transpose, as well as any permutation of its rows or columns, is the same game setup.
+fingerprint() maps all of them to the same canonical hash. DedupIndex keeps the fingerprints of known boards
+(persisted as one fingerprint per line), so the GameGenerator can skip known boards in O(1).
+
+Usage (dedupe the existing game banks, keeping the first occurrence from the oldest bank, and rebuild the index):
+    python dedup.py --language en
+    python dedup.py --language de --dry-run
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+from utils import *
+from bank import MANIFEST_FILE, read_manifest
+
+
+DEDUP_DIR = ".cache/dedup"
+
+
+def fingerprint(rows, cols) -> str:
+    """ Canonical hash of a board given by its rows and cols setkeys (category key, value),
+    invariant to row/column permutation and transposition """
+    sides = sorted(",".join(sorted(f"{key}={value}" for key, value in side)) for side in (rows, cols))
+    return hashlib.sha1("/".join(sides).encode("utf-8")).hexdigest()[:20]
+
+
+def game_fingerprint(game) -> str:
+    return fingerprint([(cat.key, value) for cat, value in game.rows], [(cat.key, value) for cat, value in game.cols])
+
+
+def json_fingerprint(data: dict) -> str:
+    """ Fingerprint of a game in its JSON form (Game.to_json) """
+    return fingerprint([(x["category"], x["value"]) for x in data["rows"]], [(x["category"], x["value"]) for x in data["cols"]])
+
+
+def default_index_path(language: str) -> str:
+    return os.path.join(DEDUP_DIR, f"{language.lower()}.txt")
+
+
+class DedupIndex:
+    """ Set of known board fingerprints. With a path, it is loaded from and saved to a text file (one fingerprint per line).
+    Fingerprints added since loading are only written by save(), e.g. once the games are saved. """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.fingerprints = set()
+        self.new = []
+        if path is not None and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.fingerprints = {line.strip() for line in f if line.strip()}
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def __contains__(self, fp):
+        return fp in self.fingerprints
+
+    def add(self, fp) -> bool:
+        """ Adds the fingerprint. Returns False if it is already known (duplicate). """
+        if fp in self.fingerprints:
+            return False
+        self.fingerprints.add(fp)
+        self.new.append(fp)
+        return True
+
+    def save(self):
+        if self.path is None or not self.new:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, mode="a", encoding="utf-8") as f:
+            f.writelines(fp + "\n" for fp in self.new)
+        print(f"{len(self.new)} new fingerprints saved to {self.path} ({len(self)} in total)")
+        self.new = []
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Deduplication of existing game banks
+
+def dedupe_bank(path: str, index: DedupIndex, dry_run=False):
+    """ Removes the games already in the index from a bank (JSON array file, compact bank file or NDJSON shard directory)
+    and adds the remaining ones. Returns (number of games, number of duplicates). """
+    if os.path.isdir(path):
+        manifest = read_manifest(path)
+        total, duplicates = 0, 0
+        for shard in manifest["shards"]:
+            with open(os.path.join(path, shard["file"]), encoding="utf-8") as f:
+                lines = [line for line in f if line.strip()]
+            keep = [line for line in lines if index.add(json_fingerprint(json.loads(line)))]
+            total, duplicates = total + len(lines), duplicates + len(lines) - len(keep)
+            if not dry_run and len(keep) < len(lines):
+                with open(os.path.join(path, shard["file"]), mode="w", encoding="utf-8") as f:
+                    f.writelines(keep)
+                levels = [json.loads(line)["data"].get("difficultyLevel") for line in keep]
+                shard["count"] = len(keep)
+                shard["levels"] = {str(level) if level is not None else "null": levels.count(level) for level in dict.fromkeys(levels)}
+        if not dry_run and duplicates:
+            manifest["count"] = total - duplicates
+            with open(os.path.join(path, MANIFEST_FILE), mode="w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=2)
+        return total, duplicates
+
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        keep = [game for game in data if index.add(json_fingerprint(game))]
+        total, duplicates = len(data), len(data) - len(keep)
+        data = keep
+    elif data.get("format") == "compact":
+        games, setkeys = data["games"], data["setkeys"]
+        keep = [k for k in range(data["count"])
+                if index.add(fingerprint([setkeys[i] for i in games["rows"][k]], [setkeys[i] for i in games["cols"][k]]))]
+        total, duplicates = data["count"], data["count"] - len(keep)
+        data["games"] = {field: [values[k] for k in keep] for field, values in games.items() if field != "data"}
+        data["games"]["data"] = {field: [values[k] for k in keep] for field, values in games["data"].items()}
+        data["count"] = len(keep)
+    else:
+        raise ValueError(f"Unknown game bank format in {path}")
+    if not dry_run and duplicates:
+        with open(path, mode="w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":") if isinstance(data, dict) else None)
+    return total, duplicates
+
+
+def dedupe_banks(language: str, data_dir="../../public/data", index_path=None, dry_run=False):
+    """ Dedupes all game banks of a language, oldest first (the first occurrence of a board is kept), and rebuilds the index """
+    games_dir = os.path.join(data_dir, "games", language.lower())
+    index = DedupIndex()
+    index.path = index_path if index_path is not None else default_index_path(language)
+    for name in sorted(os.listdir(games_dir)):
+        if name.startswith("."):  # temporary bank of an unfinished save (see bank.temp_path)
+            continue
+        total, duplicates = dedupe_bank(os.path.join(games_dir, name), index, dry_run=dry_run)
+        print(f"{name}: {total} games, {duplicates} duplicates" + (" (dry run)" if dry_run and duplicates else ""))
+    if not dry_run:
+        if os.path.exists(index.path):
+            os.remove(index.path)
+        index.save()
+    return index
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Remove duplicate boards from the TicTacGlobe game banks")
+    parser.add_argument("--language", required=True)
+    parser.add_argument("--data-dir", default="../../public/data")
+    parser.add_argument("--index", default=None, help=f"index file to rebuild (default: {DEDUP_DIR}/<language>.txt)")
+    parser.add_argument("--dry-run", action="store_true", help="only report the duplicates")
+    args = parser.parse_args(argv)
+    # Ensure we're running in the right directory
+    chdir_this_file()
+    dedupe_banks(args.language, data_dir=args.data_dir, index_path=args.index, dry_run=args.dry_run)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,7 +2,11 @@
 import pandas as pd
 import numpy as np
 import itertools
+import json
+import os
+from bisect import bisect_left
 from enum import Enum
+from ragged import RaggedArray
 
 
 COUNTRY_DIFFICULTY_WEIGHTS = {
@@ -31,6 +35,11 @@ GAME_DIFFICULTY_WEIGHTS = {
     "max_cell_difficulty": 1,
     "num_unique": 1
 }
+# Easy games: no cell over EASY_MAX_CELL_DIFFICULTY, at most EASY_MAX_UNIQUE cells with a unique solution
+# and an average cell difficulty within the easiest EASY_MAX_ORDER percent
+EASY_MAX_CELL_DIFFICULTY = 6
+EASY_MAX_UNIQUE = 2
+EASY_MAX_ORDER = 40
 
 
 class DifficultyLevel(Enum):
@@ -70,6 +79,10 @@ class DifficultyEstimator:
         self.compute_country_difficulties()
         self.category_info = self.compute_category_difficulties()
         self.cell_info = self.compute_cell_difficulties(self.category_info)
+        self.cell_index = self.get_cell_index(self.cell_info)
+        self._cell_difficulties = self.cell_info["difficulty"].to_numpy()
+        self._cell_unique = (self.cell_info["size"] == 1).to_numpy()
+        self.model = None  # DifficultyModel to level single games (see calibrate())
 
     def compute_country_difficulties(self):
         df = self.df
@@ -89,38 +102,33 @@ class DifficultyEstimator:
         setkeys = self.preprocessor.setkeys
         print(f"Compute difficulty of {len(setkeys)} category-value pairs...")
         categories = self.preprocessor.categories
-        setkeys = self.preprocessor.setkeys
-        df = self.df
-        for key, value in setkeys:
-            cat = categories[key]
-            df[(key, value)] = df.iso.apply(lambda iso: iso in cat.sets.loc[value])
+        # Setkey x country incidence matrix and the difficulty of each country of its index
+        incidence = self.preprocessor.incidence
+        matrix = incidence.matrix[[incidence.key_index[setkey] for setkey in setkeys]]
+        country_difficulties = self.df.set_index("iso")["difficulty"].reindex(incidence.countries).to_numpy()
 
-        category_info = pd.Series({(key, value): df[df[(key, value)]].difficulty.agg(list) for key, value in setkeys})
-        category_info = category_info.reset_index()
-        category_info.columns=["key", "value", "difficulties"]
+        difficulties = RaggedArray.from_mask(matrix, country_difficulties)
+
+        category_info = pd.DataFrame({"key": [key for key, value in setkeys],
+                                      "value": [value for key, value in setkeys],
+                                      "difficulties": list(difficulties)})
         cat_difficulty = normalize(category_info.key.apply(lambda key: categories[key].difficulty), scale=10)
-        category_info["difficulty"] = self.compute_solution_difficulties(category_info["difficulties"],
+        category_info["difficulty"] = self.compute_solution_difficulties(difficulties,
                                                                          CATEGORY_SOLUTION_DIFFICULTY_WEIGHTS,
                                                                          offsets=cat_difficulty)
-        category_info["countries"] = category_info.apply(lambda row: categories[row["key"]].sets.loc[row["value"]], axis=1)
+        category_info["countries"] = [categories[key].sets.loc[value] for key, value in setkeys]
         category_info.set_index(["key", "value"], inplace=True)
         return category_info
 
     @staticmethod
-    def compute_solution_difficulties(difficulties: pd.Series, weights, offsets=None):
-        if offsets is None:
-            offsets = np.zeros_like(difficulties)
-        info = difficulties.copy().rename("difficulties").reset_index()
-        info["offset"] = offsets
-        info["size"] = info.difficulties.apply(len)
+    def compute_solution_difficulties(difficulties, weights, offsets=None):
+        # difficulties: RaggedArray (or sequence of lists) with the difficulties of the solutions of each set / cell
+        if not isinstance(difficulties, RaggedArray):
+            difficulties = RaggedArray.from_lists(difficulties)
+        info = difficulties.stats()
+        info["offset"] = np.zeros(len(difficulties)) if offsets is None else np.asarray(offsets)
         info["size_sqrt"] = normalize(np.sqrt(info["size"]), scale=10)
         info["size_score"] = normalize(-np.sqrt(info["size"]), scale=10)
-        info["mean"] = info.difficulties.apply(np.mean)
-        info["min"] = info.difficulties.apply(min)
-        info["max"] = info.difficulties.apply(max)
-        info["median"] = info.difficulties.apply(np.median)
-        info["std"] = info.difficulties.apply(np.std)
-        info.drop(columns=["difficulties"], inplace=True)
         return normalized_combination(info, weights, scale=10).astype("float64")
 
     def compute_cell_difficulties(self, category_info):
@@ -133,16 +141,72 @@ class DifficultyEstimator:
         cell_info["row_col_difficulty"] = normalize(cell_info["row_difficulty"] + cell_info["col_difficulty"], scale=10)
         # cell_info["row_col_difficulty_harmonic"] = normalize((cell_info["row_difficulty"] + 1) * (cell_info["col_difficulty"] + 1), scale=10)
 
-        content_difficulties = cell_info["contents"].apply(lambda cc: df[df.iso.isin(cc)].difficulty.agg(list))
+        content_difficulties = RaggedArray.from_members(cell_info["contents"], dict(zip(df["iso"], df["difficulty"])))
         cell_info["solution_difficulty"] = self.compute_solution_difficulties(content_difficulties, CELL_SOLUTION_DIFFICULTY_WEIGHTS)
         cell_info["difficulty"] = normalized_combination(cell_info, CELL_DIFFICULTY_WEIGHTS, scale=10)
         return cell_info
 
     @staticmethod
-    def get_cell_indices(cell_data, cell_info):
-        for (cat1, val1), (cat2, val2) in itertools.product(cell_data["rows"], cell_data["cols"]):
-            (row_cat, row_val), (col_cat, col_val) = max((cat1, val1), (cat2, val2)), min((cat1, val1), (cat2, val2))
-            yield cell_info.index[(cell_info["row_cat"] == row_cat) & (cell_info["row_val"] == row_val) & (cell_info["col_cat"] == col_cat) & (cell_info["col_val"] == col_val)].tolist()[0]
+    def get_cell_index(cell_info):
+        """ Maps the canonical cell key ((row_cat, row_val), (col_cat, col_val)) to the position in cell_info """
+        return {((row_cat, row_val), (col_cat, col_val)): i for i, (row_cat, row_val, col_cat, col_val)
+                in enumerate(zip(cell_info["row_cat"], cell_info["row_val"], cell_info["col_cat"], cell_info["col_val"]))}
+
+    def get_cell_indices(self, rows, cols):
+        """ Positions (in cell_info) of all cells of a game, row by row """
+        return [self.cell_index[max(row, col), min(row, col)] for row, col in itertools.product(rows, cols)]
+
+    def score_setups(self, setups) -> pd.DataFrame:
+        """ Cell difficulty features of game setups (rows, cols) given as setkeys, for all setups at once """
+        # Gather the cell data of all games at once (games x cells)
+        cell_indices = np.array([self.get_cell_indices(rows, cols) for rows, cols in setups], dtype=np.int64).reshape(len(setups), -1)
+        cell_difficulties = self.cell_info["difficulty"].to_numpy()[cell_indices]
+        return pd.DataFrame({"cell_indices": list(cell_indices),
+                             "cell_difficulties": list(cell_difficulties),
+                             "max_cell_difficulty": cell_difficulties.max(axis=1),
+                             "avg_cell_difficulty": cell_difficulties.mean(axis=1),
+                             "num_unique": (self.cell_info["size"].to_numpy()[cell_indices] == 1).sum(axis=1)})
+
+    def cell_features(self, rows, cols):
+        """ (max_cell_difficulty, avg_cell_difficulty, num_unique) of a single game setup, the inputs of classify().
+        To score a setup against the calibrated model (level, order, difficulty), use model.score_setup(). """
+        cell_indices = self.get_cell_indices(rows, cols)
+        difficulties = self._cell_difficulties[cell_indices]
+        return difficulties.max(), difficulties.mean(), int(self._cell_unique[cell_indices].sum())
+
+    @staticmethod
+    def assign_levels(game_info):
+        """ Difficulty order (percentile of the average cell difficulty) and level of every game, relative to the batch.
+        Returns the order, the level masks (easy, medium, hard) and the bounds to level other games the same way:
+        the order bin edges, the hard bound (of the order) and the equivalent average cell difficulty bounds. """
+        # difficulty_order: "This game is harder than x% of all games."
+        order, edges = pd.qcut(game_info["avg_cell_difficulty"], q=100, labels=False, retbins=True)
+        ix_easy = (game_info["max_cell_difficulty"] < EASY_MAX_CELL_DIFFICULTY) & (game_info["num_unique"] <= EASY_MAX_UNIQUE) & (order <= EASY_MAX_ORDER)
+        hard_bound = order[~ix_easy].median()
+        ix_medium =  ~ix_easy & (order <= hard_bound)
+        ix_hard = ~ix_easy & ~ix_medium
+        # order <= k is equivalent to avg_cell_difficulty <= edges[k + 1] (bins are right-closed)
+        bounds = {"order_edges": edges.tolist(), "hard_bound": float(hard_bound),
+                  "easy_avg": edges[EASY_MAX_ORDER + 1], "medium_avg": edges[int(np.floor(hard_bound)) + 1]}
+        return order, (ix_easy, ix_medium, ix_hard), bounds
+
+    def calibrate(self, setups):
+        """ Fits the model used by classify() on a (large enough) batch of game setups (or games).
+        On the calibration batch itself, classify() yields the same levels as compute_game_difficulties(). """
+        self.model = self.fit_model(setups)
+        return self.model
+
+    def classify(self, max_cell_difficulty, avg_cell_difficulty, num_unique) -> DifficultyLevel:
+        if self.model is None:
+            raise ValueError("DifficultyEstimator is not calibrated, call calibrate() first")
+        return self.model.classify(max_cell_difficulty, avg_cell_difficulty, num_unique)
+
+    def fit_model(self, games):
+        """ Fits a DifficultyModel on a batch of games (or setups (rows, cols) given as setkeys) """
+        if len(games) and not isinstance(games[0], tuple):
+            games = [([(cat.key, value) for cat, value in game.rows], [(cat.key, value) for cat, value in game.cols]) for game in games]
+        print(f"Fit difficulty model on {len(games)} games...")
+        return DifficultyModel.fit(self, self.score_setups(games))
 
     def compute_game_difficulties(self, games):
 
@@ -152,31 +216,121 @@ class DifficultyEstimator:
         game_info = pd.DataFrame([{"game": game,
                                 "rows": [(cat.key, value) for cat, value in game.rows],
                                 "cols": [(cat.key, value) for cat, value in game.cols]} for game in games])
+        game_info = game_info.join(self.score_setups(list(zip(game_info["rows"], game_info["cols"]))))
 
-        game_info["cell_indices"] = game_info.apply(lambda cell_data: list(self.get_cell_indices(cell_data, self.cell_info)), axis=1)
-        game_info["cell_difficulties"] = game_info["cell_indices"].apply(lambda ix: self.cell_info.loc[ix, "difficulty"].tolist())
-        game_info["max_cell_difficulty"] = game_info["cell_difficulties"].apply(max)
-        game_info["avg_cell_difficulty"] = game_info["cell_difficulties"].apply(np.mean)
-        game_info["num_unique"] = game_info["game"].apply(lambda game: len([1 for solutions in sum(game.solutions, []) if len(solutions) == 1]))
+        # Final computation and Level assignment, relative to this batch
+        model = DifficultyModel.fit(self, game_info)
+        game_info = game_info.join(model.level_info(game_info))
 
-        # Final computation and Level assignment
-        game_info["difficulty"] = normalized_combination(game_info, GAME_DIFFICULTY_WEIGHTS, scale=10)
-        # difficulty_order: "This game is harder than x% of all games."
-        game_info["difficulty_order"] = pd.qcut(game_info["avg_cell_difficulty"], q=100, labels=False)
-        ix_easy = (game_info["max_cell_difficulty"] < 6) & (game_info["num_unique"] <= 2) & (game_info["difficulty_order"] <= 40)
-        hard_bound = game_info[~ix_easy]["difficulty_order"].median()
-        ix_medium =  ~ix_easy & (game_info["difficulty_order"] <= hard_bound)
-        ix_hard = ~ix_easy & ~ix_medium
+        for game, max_difficulty, avg_difficulty, level in zip(games, game_info["max_cell_difficulty"], game_info["avg_cell_difficulty"], game_info["level"]):
+            game.data["max_cell_difficulty"] = max_difficulty
+            game.data["avg_cell_difficulty"] = avg_difficulty
+            game.data["difficulty_level"] = str(level)
+
+        return game_info
 
-        game_info["level"] = 0
-        game_info.loc[ix_easy, "level"] = DifficultyLevel.EASY
-        game_info.loc[ix_medium, "level"] = DifficultyLevel.MEDIUM
-        game_info.loc[ix_hard, "level"] = DifficultyLevel.HARD
 
-        for i, game in enumerate(games):
-            game.data["max_cell_difficulty"] = game_info.loc[i, "max_cell_difficulty"]
-            game.data["avg_cell_difficulty"] = game_info.loc[i, "avg_cell_difficulty"]
-            game.data["difficulty_level"] = str(game_info.loc[i, "level"])
+class DifficultyModel:
+    """ Frozen game scoring: the cell difficulties plus the normalization bounds, difficulty order (percentile) edges
+    and level bounds of the batch it was fitted on. New games are scored in constant time against the model,
+    so appending games to a bank does not require rescoring the whole bank. On the fitting batch, the results
+    are identical to DifficultyEstimator.compute_game_difficulties(). """
 
-        return game_info
+    VERSION = 1
+
+    def __init__(self, cells, difficulty_bounds, order_edges, hard_bound):
+        # cells: canonical cell key -> (difficulty, has a unique solution)
+        self.cells = cells
+        self.difficulty_bounds = difficulty_bounds  # min, max of the linear combination of GAME_DIFFICULTY_WEIGHTS
+        self.order_edges = order_edges  # 101 bin edges of the average cell difficulty (difficulty order 0..99)
+        self.hard_bound = hard_bound  # games of higher difficulty order are hard
+
+    @staticmethod
+    def fit(estimator, game_info):
+        """ Fits the model on the cell difficulty features of a batch (see DifficultyEstimator.score_setups) """
+        cells = {key: (float(difficulty), bool(size == 1)) for key, difficulty, size
+                 in zip(estimator.cell_index.keys(), estimator.cell_info["difficulty"], estimator.cell_info["size"])}
+        combination = linear_combination(game_info, GAME_DIFFICULTY_WEIGHTS)
+        _, _, bounds = DifficultyEstimator.assign_levels(game_info)
+        return DifficultyModel(cells, (float(combination.min()), float(combination.max())), bounds["order_edges"], bounds["hard_bound"])
+
+    def level_info(self, game_info) -> pd.DataFrame:
+        """ Difficulty, difficulty order and level of a batch of games from their cell difficulty features """
+        low, high = self.difficulty_bounds
+        difficulty = 10 * (linear_combination(game_info, GAME_DIFFICULTY_WEIGHTS) - low) / (high - low)
+        # Bins are right-closed, the lowest edge is included
+        order = np.clip(np.searchsorted(self.order_edges, game_info["avg_cell_difficulty"], side="left") - 1, 0, len(self.order_edges) - 2)
+        ix_easy = (game_info["max_cell_difficulty"] < EASY_MAX_CELL_DIFFICULTY) & (game_info["num_unique"] <= EASY_MAX_UNIQUE) & (order <= EASY_MAX_ORDER)
+        ix_medium = ~ix_easy & (order <= self.hard_bound)
+        level = np.where(ix_easy, DifficultyLevel.EASY, np.where(ix_medium, DifficultyLevel.MEDIUM, DifficultyLevel.HARD))
+        return pd.DataFrame({"difficulty": difficulty, "difficulty_order": order, "level": level}, index=game_info.index)
+
+    def score_setup(self, rows, cols) -> dict:
+        """ Scores a single game setup (rows, cols given as setkeys) """
+        cells = [self.cells[max(row, col), min(row, col)] for row, col in itertools.product(rows, cols)]
+        difficulties = np.array([difficulty for difficulty, unique in cells])
+        info = {"max_cell_difficulty": difficulties.max(),
+                "avg_cell_difficulty": difficulties.mean(),
+                "num_unique": sum(unique for difficulty, unique in cells)}
+        low, high = self.difficulty_bounds
+        info["difficulty"] = 10 * (sum(w * info[col] for col, w in GAME_DIFFICULTY_WEIGHTS.items()) - low) / (high - low)
+        info["difficulty_order"] = self.order(info["avg_cell_difficulty"])
+        info["level"] = self.classify(info["max_cell_difficulty"], info["avg_cell_difficulty"], info["num_unique"])
+        return info
+
+    def order(self, avg_cell_difficulty) -> int:
+        """ Difficulty order (percentile bin of the fitting batch). Bins are right-closed, the lowest edge is included. """
+        return min(max(bisect_left(self.order_edges, avg_cell_difficulty) - 1, 0), len(self.order_edges) - 2)
 
+    def classify(self, max_cell_difficulty, avg_cell_difficulty, num_unique) -> DifficultyLevel:
+        order = self.order(avg_cell_difficulty)
+        if max_cell_difficulty < EASY_MAX_CELL_DIFFICULTY and num_unique <= EASY_MAX_UNIQUE and order <= EASY_MAX_ORDER:
+            return DifficultyLevel.EASY
+        if order <= self.hard_bound:
+            return DifficultyLevel.MEDIUM
+        return DifficultyLevel.HARD
+
+    def transform(self, games):
+        """ Scores a stream of games, setting their difficulty data. Yields the games. """
+        for game in games:
+            info = self.score_setup([(cat.key, value) for cat, value in game.rows], [(cat.key, value) for cat, value in game.cols])
+            game.data["max_cell_difficulty"] = info["max_cell_difficulty"]
+            game.data["avg_cell_difficulty"] = info["avg_cell_difficulty"]
+            game.data["difficulty_level"] = str(info["level"])
+            yield game
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Serialization
+
+    def to_json(self):
+        return {
+            "format": "difficulty-model",
+            "version": self.VERSION,
+            "weights": GAME_DIFFICULTY_WEIGHTS,
+            "difficultyBounds": list(self.difficulty_bounds),
+            "orderEdges": self.order_edges,
+            "hardBound": self.hard_bound,
+            "cells": [[row_cat, row_val, col_cat, col_val, difficulty, unique]
+                      for ((row_cat, row_val), (col_cat, col_val)), (difficulty, unique) in self.cells.items()],
+        }
+
+    @staticmethod
+    def from_json(data):
+        if data.get("format") != "difficulty-model" or data.get("version") != DifficultyModel.VERSION:
+            raise ValueError(f"Unsupported difficulty model (format {data.get('format')}, version {data.get('version')})")
+        if data["weights"] != GAME_DIFFICULTY_WEIGHTS:
+            raise ValueError("Difficulty model was fitted with different GAME_DIFFICULTY_WEIGHTS, refit it")
+        cells = {((row_cat, row_val), (col_cat, col_val)): (difficulty, unique)
+                 for row_cat, row_val, col_cat, col_val, difficulty, unique in data["cells"]}
+        return DifficultyModel(cells, tuple(data["difficultyBounds"]), data["orderEdges"], data["hardBound"])
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, mode="w", encoding="utf-8") as f:
+            json.dump(self.to_json(), f, separators=(",", ":"))
+        print(f"Difficulty model saved to {path}")
+
+    @staticmethod
+    def load(path: str):
+        with open(path, encoding="utf-8") as f:
+            return DifficultyModel.from_json(json.load(f))
@@ -0,0 +1,188 @@
+import tqdm
+import numpy as np
+from math import comb
+from generator import GameGenerator, ConstraintTracker
+
+
+def bitmask(ids) -> int:
+    mask = 0
+    for i in ids:
+        mask |= 1 << int(i)
+    return mask
+
+
+def iter_bits(mask: int):
+    """ Yields the positions of the set bits of mask in increasing order """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class BoardEnumerator:
+    """ Exhaustive enumeration of all valid game setups (rows and cols setkeys) of a Preprocessor.
+
+    The rules are the same as in GameGenerator: all cells must have solutions, no setkey is used twice,
+    a category appears at most twice on one side and only MultiNominal categories may cross (once on each side).
+    The setups are walked by backtracking over the rows with forward checking of the possible columns.
+    Constraint counters are tracked incrementally, so partial setups exceeding a constraint are pruned early.
+    Symmetries are broken by only visiting sorted rows and cols, and only the orientation whose first row
+    has the smallest id of all used setkeys (the transposed board is the same game setup). """
+
+    def __init__(self, preprocessor, constraints=[]):
+        self.generator = GameGenerator(preprocessor, category_probs=None, constraints=constraints)
+        self.setkeys = self.generator.setkeys
+        self.field_size = self.generator.field_size
+        self.constraints = constraints
+
+        n = len(self.setkeys)
+        self.neighbors = [bitmask(np.flatnonzero(self.generator.neighbors[i])) for i in range(n)]
+        self.setkey_cats = self.generator.setkey_cats.tolist()
+        self.category_multi_nominal = self.generator.category_multi_nominal.tolist()
+        self.category_masks = [bitmask(np.flatnonzero(self.generator.setkey_cats == k)) for k in range(len(self.category_multi_nominal))]
+
+        # Separate constraint trackers for the rows (outer loop) and for complete setups (inner loop)
+        self.row_tracker = ConstraintTracker(self.generator, constraints)
+        self.tracker = ConstraintTracker(self.generator, constraints)
+
+        self._row_counts = None  # {rows: number of valid column choices}, filled by count()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Search
+
+    def _col_domain(self, rows):
+        """ Bitmask of setkeys that may be used as columns for the given (partial) rows """
+        domain = ~0 << (rows[0] + 1)  # symmetry breaking: all cols have larger ids than the first row
+        for r in rows:
+            domain &= self.neighbors[r]
+        for k, num in enumerate(self._cat_counts(rows)):
+            if num >= 2 or (num == 1 and not self.category_multi_nominal[k]):
+                domain &= ~self.category_masks[k]
+        return domain
+
+    def _cat_counts(self, ids):
+        counts = [0] * len(self.category_masks)
+        for i in ids:
+            counts[self.setkey_cats[i]] += 1
+        return counts
+
+    def _iter_rows(self):
+        """ Yields all sorted row tuples for which at least field_size columns remain possible (forward checking) """
+        n = len(self.setkeys)
+
+        def extend(rows, cat_counts):
+            if len(rows) == self.field_size:
+                yield tuple(rows)
+                return
+            for r in range(rows[-1] + 1 if rows else 0, n):
+                k = self.setkey_cats[r]
+                if cat_counts[k] >= 2:
+                    continue
+                rows.append(r)
+                if self.constraints:
+                    self.row_tracker.add(r, [])
+                if self._col_domain(rows).bit_count() >= self.field_size and not (self.constraints and self.row_tracker.exceeded()):
+                    cat_counts[k] += 1
+                    yield from extend(rows, cat_counts)
+                    cat_counts[k] -= 1
+                if self.constraints:
+                    self.row_tracker.remove(r, [])
+                rows.pop()
+
+        self.row_tracker.reset()
+        yield from extend([], [0] * len(self.category_masks))
+
+    def _iter_cols(self, rows):
+        """ Yields all sorted column tuples that complete the given rows to a valid setup """
+        domain = list(iter_bits(self._col_domain(rows)))
+        row_cats = self._cat_counts(rows)
+        caps = [2 if num == 0 else 1 for num in row_cats]
+
+        def extend(cols, start, cat_counts):
+            if len(cols) == self.field_size:
+                if not self.constraints or self.tracker.check():
+                    yield tuple(cols)
+                return
+            for pos in range(start, len(domain) - (self.field_size - len(cols)) + 1):
+                c = domain[pos]
+                k = self.setkey_cats[c]
+                if cat_counts[k] >= caps[k]:
+                    continue
+                cols.append(c)
+                if self.constraints:
+                    self.tracker.add(c, rows)
+                if not (self.constraints and self.tracker.exceeded()):
+                    cat_counts[k] += 1
+                    yield from extend(cols, pos + 1, cat_counts)
+                    cat_counts[k] -= 1
+                if self.constraints:
+                    self.tracker.remove(c, rows)
+                cols.pop()
+
+        self.tracker.rebuild([], rows)
+        yield from extend([], 0, [0] * len(self.category_masks))
+
+    def _count_cols(self, rows):
+        if self.constraints:
+            return sum(1 for _ in self._iter_cols(rows))
+        # Without constraints, count the column choices per category: product of sum_j C(m_k, j) x^j (j <= cap_k)
+        domain_cats = self._cat_counts(iter_bits(self._col_domain(rows)))
+        row_cats = self._cat_counts(rows)
+        poly = [1] + [0] * self.field_size
+        for k, m in enumerate(domain_cats):
+            if m == 0:
+                continue
+            cap = 2 if row_cats[k] == 0 else 1
+            factor = [comb(m, j) for j in range(min(cap, m) + 1)]
+            poly = [sum(poly[i - j] * factor[j] for j in range(len(factor)) if i - j >= 0) for i in range(self.field_size + 1)]
+        return poly[self.field_size]
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Interface
+
+    def count(self, progress_bar=False):
+        """ Number of valid game setups (up to row/column permutation and transposition) """
+        if self._row_counts is None:
+            rows_iter = tqdm.tqdm(self._iter_rows(), unit="rows") if progress_bar else self._iter_rows()
+            self._row_counts = {}
+            for rows in rows_iter:
+                num = self._count_cols(rows)
+                if num > 0:
+                    self._row_counts[rows] = num
+        return sum(self._row_counts.values())
+
+    def __iter__(self):
+        return self.boards()
+
+    def boards(self):
+        """ Streams all valid game setups as (rows, cols) lists of setkeys """
+        for rows in self._iter_rows():
+            for cols in self._iter_cols(rows):
+                yield [self.setkeys[i] for i in rows], [self.setkeys[i] for i in cols]
+
+    def sample(self, n=1, seed=None):
+        """ Draws n game setups uniformly (with replacement) from all valid setups """
+        rng = np.random.default_rng(seed)
+        if self.count() == 0:
+            return []
+        row_choices = list(self._row_counts.keys())
+        weights = np.array(list(self._row_counts.values()), dtype=np.float64)
+        setups = []
+        for pos in rng.choice(len(row_choices), size=n, p=weights / weights.sum()):
+            rows = row_choices[pos]
+            cols = list(self._iter_cols(rows))
+            cols = cols[rng.integers(len(cols))]
+            setups.append(([self.setkeys[i] for i in rows], [self.setkeys[i] for i in cols]))
+        return setups
+
+    def sample_games(self, n=100, seed=None):
+        """ Draws n games uniformly from all valid setups, with random order and orientation of rows and cols """
+        rng = np.random.default_rng(seed)
+        games = []
+        for rows, cols in self.sample(n, seed=rng):
+            rng.shuffle(rows)
+            rng.shuffle(cols)
+            if rng.random() > .5:
+                rows, cols = cols, rows
+            games.append(self.generator._create_game(rows, cols))
+        return games
@@ -35,6 +35,15 @@ class Game:
         }
         
         return data
+
+    def to_compact_json(self, setkey_ids: dict):
+        """ Compact form referencing the setkeys by id (setkey_ids: (category key, value) -> id). Cells are stored once per bank. """
+        return {
+            "size": self.size,
+            "rows": [setkey_ids[(cat.key, value)] for cat, value in self.rows],
+            "cols": [setkey_ids[(cat.key, value)] for cat, value in self.cols],
+            "data": {camel_case(key): value for key, value in self.data.items()}
+        }
     
     def to_dataframe(self, solution=False):
         game_df = pd.DataFrame(data=[[",".join(c1) + (",(" + ",".join(c2) + ")" if c2 else "") for c1, c2 in zip(row1, row2)] for row1, row2 in zip(self.solutions, self.alt_solutions)] if solution else None,
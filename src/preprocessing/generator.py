@@ -1,23 +1,32 @@
 
-import random
-from collections import Counter
+import multiprocessing
 import tqdm
-import pandas as pd
 import numpy as np
-import itertools
 from category import *
 from game import *
+from sampler import SetkeySampler
+from constraints import *
+from stats import GenerationStats
+from dedup import fingerprint
 
 
 class Constraint:
-    def __init__(self, prop, num, mode):
+    def __init__(self, prop, num, mode, spec=None):
         # prop: CategoryConstraint: function mapping a set (cat key, value) to some boolean value
         # ...   CellConstraint: function mapping a cell ((key, value), (key, value), solutions) to some boolean value
         # num: number of categories
         # mode: -1: at most *num* matching categories. 0: exactly *num* matching categories. 1: at least *num* categories
+        # spec: equivalent declarative constraint (ConstraintSpec), if any
         self.prop = prop
         self.num = num
         self.mode = mode
+        self.spec = spec
+
+    def to_spec(self):
+        """ Declarative form of the constraint, used to compile it. Falls back to evaluating prop. """
+        if self.spec is not None:
+            return self.spec
+        return PropSpec(self.match, self.num, self.mode, target="setkey" if isinstance(self, CategoryConstraint) else "cell")
         
     def count(self, haystack):
         return len([item for item in haystack if self.match(*item)])
@@ -44,14 +53,13 @@ class Constraint:
     
     @staticmethod
     def category(key, n, mode):
-        return CategoryConstraint(lambda k, _: k == key, n, mode)
+        return CategoryConstraint(lambda k, _: k == key, n, mode, spec=CategoryCountSpec([key], n, mode))
     
     @staticmethod
     def solutions_at_most(country_codes, n):
         """ This constrained is added for each country. Constraints are not applied to cells, but to  """
         for c in country_codes:
-            prop = lambda row, col, solutions, c=c: c in solutions
-            yield CellConstraint.at_most(prop, n)
+            yield SolutionConstraint(c, n, -1)
     
     @staticmethod
     def category_exactly(key, n):
@@ -114,11 +122,106 @@ class CellConstraint(Constraint):
     @staticmethod
     def at_least(prop, n):
         return CellConstraint(prop, n, 1)
-    
-    
+
+
+class SolutionConstraint(CellConstraint):
+    """ Limits the number of cells a country is a solution of. Tracked as one counter per country by the ConstraintTracker. """
+    def __init__(self, country, num, mode):
+        self.country = country
+        super().__init__(lambda row, col, solutions: country in solutions, num, mode, spec=SolutionCountSpec([country], num, mode))
+
+
+class ConstraintTracker:
+    """ Constraint counters of a partial game setup, updated incrementally when a row or column is added or removed.
+    The constraints are compiled once (see CompiledConstraints): every setkey and every (canonical) cell adds
+    a fixed vector to the counters, e.g. one counter per country for SolutionConstraints. """
+
+    def __init__(self, generator, constraints):
+        self.generator = generator
+        cells = [(row, col, contents) for (row, col), (contents, alt_contents) in generator.cells.items() if contents]
+        self.compiled = compile_constraints(constraints, generator.setkeys, cells)
+        self.setkey_vectors = self.compiled.setkey_vectors
+        self.cell_vectors = self.compiled.cell_vectors
+        self.lower = self.compiled.lower
+        self.upper = self.compiled.upper
+        self.unsatisfiable = self.compiled.unsatisfiable
+        # Underfed constraints are preferred per group: category constraints / cell constraints (incl. countries)
+        self.is_category_counter = self.compiled.is_category_counter
+
+        self.reset()
+
+    def reset(self):
+        self.sides = (set(), set())
+        self.counts = np.zeros(len(self.lower), dtype=np.int64)
+
+    def in_sync(self, cross_ids, parallel_ids):
+        return {frozenset(cross_ids), frozenset(parallel_ids)} == {frozenset(side) for side in self.sides}
+
+    def rebuild(self, cross_ids, parallel_ids):
+        self.reset()
+        for setkey_id in parallel_ids:
+            self.add(setkey_id, [])
+        for setkey_id in cross_ids:
+            self.add(setkey_id, parallel_ids)
+
+    def _delta(self, setkey_id, cross_ids):
+        new_cells = self.generator.cell_ids[setkey_id, list(cross_ids)]
+        return self.setkey_vectors[setkey_id] + self.cell_vectors[new_cells].sum(axis=0)
+
+    def add(self, setkey_id, cross_ids):
+        """ Adds a setkey crossing the setkeys cross_ids (which must form one side of the tracked setup) """
+        cross = set(cross_ids)
+        side = 0 if self.sides[1] == cross else 1
+        if self.sides[1 - side] != cross:
+            raise ValueError("Cross sets do not match the tracked setup")
+        self.sides[side].add(setkey_id)
+        self.counts += self._delta(setkey_id, cross_ids)
+
+    def remove(self, setkey_id, cross_ids):
+        """ Removes a setkey that was previously added, crossing the setkeys cross_ids """
+        side = 0 if setkey_id in self.sides[0] else 1
+        self.sides[side].remove(setkey_id)
+        self.counts -= self._delta(setkey_id, cross_ids)
+
+    def filter(self, candidates, cross_ids, prefer_underfed=True):
+        """ Filters candidate setkey ids (all forming cells with cross_ids) to those not exceeding any upper bound.
+        With prefer_underfed, only candidates contributing to some underfed constraint are returned (if there are any). """
+        candidates = np.asarray(candidates, dtype=np.int64)
+        new_cells = self.generator.cell_ids[np.ix_(list(cross_ids), candidates)]  # cross sets x candidates
+        delta = self.setkey_vectors[candidates] + self.cell_vectors[new_cells].sum(axis=0)  # candidates x counters
+
+        # Strictly prohibited to exceed an at-most or exactly constraint
+        allowed = ~(self.counts + delta > self.upper).any(axis=1)
+        candidates, delta = candidates[allowed], delta[allowed]
+        if not prefer_underfed:
+            return candidates
+
+        # underfed: needs more. Only take those sets that satisfy some underfed constraint (of each group)
+        underfed = self.counts < self.lower
+        satisfy = np.ones(len(candidates), dtype=bool)
+        for group in (self.is_category_counter, ~self.is_category_counter):
+            if (underfed & group).any():
+                satisfy &= (delta[:, underfed & group] > 0).any(axis=1)
+        if satisfy.any():
+            return candidates[satisfy]
+        return candidates
+
+    def exceeded(self):
+        """ Whether an upper bound is already exceeded (the setup cannot become valid by adding more sets) """
+        return bool((self.counts > self.upper).any())
+
+    def check(self):
+        """ Whether all constraints are satisfied by the tracked setup """
+        return not self.unsatisfiable and bool(((self.counts >= self.lower) & (self.counts <= self.upper)).all())
+
+    def violations(self):
+        """ Descriptions of the constraints not satisfied by the tracked setup """
+        violated = np.flatnonzero((self.counts < self.lower) | (self.counts > self.upper))
+        return (["unsatisfiable"] if self.unsatisfiable else []) + [self.compiled.labels[i] for i in violated]
+
 
 class GameGenerator:
-    def __init__(self, preprocessor, category_probs, constraints=[], seed=None, selection_mode="shuffle_categories", precompute_probs=True, uniform=False, shuffle=True):
+    def __init__(self, preprocessor, category_probs, constraints=[], seed=None, selection_mode="shuffle_categories", precompute_probs=True, uniform=False, shuffle=True, dedup_index=None, max_backtracks=None, keep_board_stats=False):
         self.categories = preprocessor.categories
         self.setkeys = preprocessor.setkeys
         self.cells = preprocessor.cells
@@ -131,191 +234,94 @@ class GameGenerator:
         self.shuffle = shuffle  # Whether to shuffle the resulting rows and columns
         self.seed = seed
         self.random = np.random.default_rng(seed=seed)
+        self.seed_seq = np.random.SeedSequence(seed)  # spawns the random streams of parallel chunks (see sample_games)
+        self.dedup_index = dedup_index  # DedupIndex of known boards. Known boards are skipped, new ones are added.
+        self._known_fingerprints = None  # frozen snapshot of the index checked by parallel chunks (see _sample_games_parallel)
+        # Backtracking budget per try (see _sample_game_setup_backtracking). 0: restart the board on every dead end.
+        # By default, only boards larger than 3x3 backtrack, as the restart rate grows quickly with the field size.
+        self.max_backtracks = max_backtracks if max_backtracks is not None else (0 if self.field_size <= 3 else DEFAULT_MAX_BACKTRACKS)
         
-        self.df_sample = None
-        self.df_cats = None
-        self.precomputed_probs = False
-
-        if precompute_probs:
-            self._init_sample_df()
-
-    def _init_sample_df(self):
-
-        sample = pd.DataFrame([{"cat": key, "value": value} for key, value in self.setkeys])
-        cats = None
-        cat_size = sample["cat"].value_counts().rename("cat_size")
-        cat_prob = pd.Series(self.category_probs, name="cat_prob")
-
-        if self.selection_mode == "shuffle_setkeys":  # DEPR: this leads to unprobable categories being selected almost *never* because the frequent categories have many values
-            if self.uniform:
-                sample["prob0"] = 1
-            else:
-                sample = sample.join(cat_prob, on="cat")
-                sample = sample.join(cat_size, on="cat")
-                sample["prob0"] = sample["cat_prob"] / sample["cat_size"]
-            # sample["prob0"] = sample["prob0"] / sample["prob0"].sum()
-            # prob0: initial probability. Need new column "prob" to normalize to sum 1 in each iteration
-        
-        elif self.selection_mode == "shuffle_categories":  # NEW
-            cats = pd.merge(cat_size, cat_prob, left_index=True, right_index=True)
-            if self.uniform:
-                sample["cat_index"] = np.nan
-                # sample = sample.join(cat_size.apply(lambda n: self.random.random()).rename("cat_index"), on="cat")
-            else:
-                cats["cat_index"] = np.nan
-                sample["cat_index"] = np.nan
-                # cats = cats.sample(len(cats), replace=False, weights="cat_prob", random_state=random_state)
-                # cats["cat_index"] = range(len(cats))
-                # sample = sample.join(cats["cat_index"], on="cat")
-            
-            sample["rnd"] = np.nan
-            # sample["rnd"] = self.random.random(size=len(sample))
-            # sample.sort_values(["cat_index", "rnd"], inplace=True)
-        
-        self.df_sample = sample
-        self.df_cats = cats
-        self.precomputed_probs = True
+        self.precomputed_probs = precompute_probs
+
+        self._init_compatibility_graph()
+        self._init_sampler()
+        self.tracker = ConstraintTracker(self, self.constraints)
+        # Aggregate telemetry only by default, as per-board records grow with the number of generated games
+        self.stats = GenerationStats(keep_boards=keep_board_stats)
+
+    def __getstate__(self):
+        # For spawned worker processes: the constraints (which may hold lambdas) are only needed compiled (tracker)
+        return {k: v for k, v in self.__dict__.items() if k != "constraints"}
+
+    def _init_compatibility_graph(self):
+        """ Assigns integer ids to setkeys and cells. Two setkeys are neighbors if they form a non-empty cell. """
+        n = len(self.setkeys)
+        self.setkey_ids = {setkey: i for i, setkey in enumerate(self.setkeys)}
+
+        # Canonical cell ids, accessible under both orientations (row, col) and (col, row)
+        self.cell_ids = np.full((n, n), -1, dtype=np.int64)
+        self.cell_contents = []
+        self.cell_alt_contents = []
+        for (row, col), (contents, alt_contents) in self.cells.items():
+            if not contents:
+                continue
+            i, j = self.setkey_ids[row], self.setkey_ids[col]
+            self.cell_ids[i, j] = self.cell_ids[j, i] = len(self.cell_contents)
+            self.cell_contents.append(contents)
+            self.cell_alt_contents.append(alt_contents)
+        self.neighbors = self.cell_ids >= 0
+
+        # Category of each setkey, to check the category rules with counters
+        self.category_keys = list(sorted({key for key, value in self.setkeys}))
+        self.setkey_cats = np.array([self.category_keys.index(key) for key, value in self.setkeys], dtype=np.int64)
+        self.category_multi_nominal = np.array([isinstance(self.categories[key], MultiNominalCategory) for key in self.category_keys], dtype=bool)
+
+    def _init_sampler(self):
+        # Category probabilities by category index (categories without probability get weight 0, see SetkeySampler)
+        category_weights = np.array([self.category_probs.get(key, 0) if self.category_probs else 0 for key in self.category_keys], dtype=np.float64)
+        self.sampler = SetkeySampler(self.setkey_cats, category_weights,
+                                     selection_mode=self.selection_mode,
+                                     uniform=self.uniform,
+                                     precomputed=self.precomputed_probs)
 
     def _shuffle_setkeys(self, choice):
-        
-        random_state = self.seed  # when pandas updates, change to self.random (np.random.Generator instance)
-        
-        if self.precomputed_probs:
-
-            sample = self.df_sample
-            cats = self.df_cats
-
-            # Prepare filter (values available in choice)
-            ix = sample.apply(lambda row: (row["cat"], row["value"]) in choice, axis=1)
-
-            if self.selection_mode == "shuffle_setkeys":  # DEPR: this leads to unprobable categories being selected almost *never* because the frequent categories have many values
-                sample = sample[ix]
-                prob = sample["prob0"] / sample["prob0"].sum()
-                # shuffle category-value pairs with weights
-
-                # ValueError: Fewer non-zero entries in p than size
-                # nonzero = (prob > 0).sum()
-                # if nonzero < len(sample):
-                #     print(f"Too few values to sample ({nonzero} < {len(sample)})")
-                #     print(sample.sort_values("prob0"))
-                sample = sample.sample(len(sample), replace=False, weights=prob, random_state=random_state)
-            
-            elif self.selection_mode == "shuffle_categories":  # NEW
-                if self.uniform:
-                    # "shuffle" categories uniformly
-                    cats["cat_index"] = self.random.random(size=len(cats))
-                else:
-                    # shuffle categories with weights
-                    cats = cats.sample(len(cats), replace=False, weights="cat_prob", random_state=random_state)
-                    cats["cat_index"] = range(len(cats))
-                
-                sample["cat_index"] = sample["cat"].map(cats["cat_index"])
-                sample["rnd"] = self.random.random(size=len(sample))
-                sample = sample[ix]  # only now filter, cannot change values inside slice
-                sample = sample.sort_values(["cat_index", "rnd"])
-            
-            # print("---------------")
-            # print(sample)
-            return sample.apply(lambda row: (row["cat"], row["value"]), axis=1).tolist()
-
-        if not self.precomputed_probs:
-
-            sample = pd.DataFrame([{"cat": key, "value": value} for key, value in choice])
-
-            cat_size = sample["cat"].value_counts().rename("cat_size")
-            cat_prob = pd.Series(self.category_probs, name="cat_prob")
-
-            if self.selection_mode == "shuffle_setkeys":  # DEPR: this leads to unprobable categories being selected almost *never* because the frequent categories have many values
-                if self.uniform:
-                    sample["prob"] = 1
-                else:
-                    sample = sample.join(cat_prob, on="cat")
-                    sample = sample.join(cat_size, on="cat")
-                    sample["prob"] = sample["cat_prob"] / sample["cat_size"]
-                
-                # Idea: Might still use this, but pre-compute probabilities and just filter (reducing the cumulative category probabilities when certain values are not possible)
-                sample["prob"] = sample["prob"] / sample["prob"].sum()
-                sample = sample.sample(len(sample), replace=False, weights="prob", random_state=random_state)
-            
-            elif self.selection_mode == "shuffle_categories":  # NEW
-                
-                if self.uniform:
-                    sample = sample.join(cat_size.apply(lambda n: self.random.random()).rename("cat_index"), on="cat")
-                else:
-                    cats = pd.merge(cat_size, cat_prob, left_index=True, right_index=True)
-                    cats = cats.sample(len(cats), replace=False, weights="cat_prob", random_state=random_state)
-                    cats["cat_index"] = range(len(cats))
-                    sample = sample.join(cats["cat_index"], on="cat")
-                
-                sample["rnd"] = self.random.random(size=len(sample))
-                sample.sort_values(["cat_index", "rnd"], inplace=True)
-            
-            # print(sample)
-            return sample.apply(lambda row: (row["cat"], row["value"]), axis=1).tolist()
-
-    def _cell_constraint_info(self, rows, cols):
-        # Prepares the arguments to apply a cell constraint.
-        return [(row, col, self._get_solutions(row, col, alt=False)) for row, col in itertools.product(rows, cols)]
+        ids = [self.setkey_ids[setkey] for setkey in choice]
+        return [self.setkeys[i] for i in self.sampler.shuffle(ids, self.random)]
 
     def _get_allowed_sets(self, cross_sets, parallel_sets):
-        choice = self.setkeys
+        cross_ids = [self.setkey_ids[setkey] for setkey in cross_sets]
+        parallel_ids = [self.setkey_ids[setkey] for setkey in parallel_sets]
+        allowed = np.ones(len(self.setkeys), dtype=bool)
         # Not 2 identical (cat, value) sets in the game
-        choice = set(choice).difference(cross_sets).difference(parallel_sets)
+        allowed[cross_ids] = False
+        allowed[parallel_ids] = False
         # Not 2 crossing identical categories, except MultiNominal, but then only 1 each
         # Each category only allowed twice
-        cross_cats = Counter(cat for cat, value in cross_sets)
-        parallel_cats = Counter(cat for cat, value in parallel_sets)
-        choice = {(cat, value) for cat, value in choice
-                if (cat not in cross_cats and parallel_cats.get(cat, 0) <= 1)
-                or (isinstance(self.categories[cat], MultiNominalCategory) and cross_cats[cat] == 1 and cat not in parallel_cats)}
-        
-        # Generate a preview of the newly added cells with their solutions
-        new_cells_choice = {(key, value): self._cell_constraint_info(cross_sets, [(key, value)]) for key, value in choice}
-        # Filter out where no solutions exist
-        choice = [(cat, value) for cat, value in choice if all([solutions is not None and len(solutions) > 0 for _,_,solutions in new_cells_choice[(cat, value)]])]
-
-
-        # Check constraint balances
-        # print("_cell_constraint_info:", self._cell_constraint_info(cross_sets, parallel_sets))
-        category_constraints = [c for c in self.constraints if isinstance(c, CategoryConstraint)]
-        cell_constraints = [c for c in self.constraints if isinstance(c, CellConstraint)]
-        balance_category = [c.balance(cross_sets + parallel_sets) for c in self.constraints if isinstance(c, CategoryConstraint)]
-        balance_cell = [c.balance(self._cell_constraint_info(cross_sets, parallel_sets)) for c in self.constraints if isinstance(c, CellConstraint)]
-        underfed_category = [c for (a, b), c in zip(balance_category, category_constraints) if a is not None and a > 0]
-        overfed_category = [c for (a, b), c in zip(balance_category, category_constraints) if b == 0]
-        underfed_cell = [c for (a, b), c in zip(balance_cell, cell_constraints) if a is not None and a > 0]
-        overfed_cell = [c for (a, b), c in zip(balance_cell, cell_constraints) if b == 0]
-
-        # underfed: needs more. overfed: maximum is reached.
-        # Strictly prohibited to satisfy an already overfed constraint
-        choice = [(key, value) for key, value in choice
-                if not any(o.match(key, value) for o in overfed_category)
-                and not any(any(o.match(row, col, solutions) for row, col, solutions in new_cells_choice[(key, value)]) for o in overfed_cell)]
-        
-        choice_ignore_underfed = choice
-        # Only take those sets that satisfy some underfed constraint
-        choice_satisfy_underfed = [(key, value) for key, value in choice
-                                   if (any(u.match(key, value) for u in underfed_category) or not underfed_category)
-                                   and (any(any(u.match(row, col, solutions) for row, col, solutions in new_cells_choice[(key, value)]) for u in underfed_cell) or not underfed_cell)]
-        
-        if len(choice_satisfy_underfed) > 0:
-            choice = choice_satisfy_underfed
-        else:
-            choice = choice_ignore_underfed
-        
-        return choice
+        cross_cats = np.bincount(self.setkey_cats[cross_ids], minlength=len(self.category_keys))
+        parallel_cats = np.bincount(self.setkey_cats[parallel_ids], minlength=len(self.category_keys))
+        cats_allowed = (((cross_cats == 0) & (parallel_cats <= 1))
+                        | (self.category_multi_nominal & (cross_cats == 1) & (parallel_cats == 0)))
+        allowed &= cats_allowed[self.setkey_cats]
+        # Filter out where no solutions exist (must be a neighbor of all cross sets)
+        allowed &= np.logical_and.reduce(self.neighbors[cross_ids], axis=0)
+
+        # Check constraint balances (only allow sets that do not exceed a constraint, prefer those needed by a constraint)
+        if not self.tracker.in_sync(cross_ids, parallel_ids):
+            self.tracker.rebuild(cross_ids, parallel_ids)
+        choice = self.tracker.filter(np.flatnonzero(allowed), cross_ids)
+        return [self.setkeys[i] for i in choice]
 
     def _get_solutions(self, row, col, alt=False):
-        i = 1 if alt else 0
-        if (row, col) in self.cells:
-            return self.cells[(row, col)][i]
-        if (col, row) in self.cells:
-            return self.cells[(col, row)][i]
-        return None
+        cell_id = self.cell_ids[self.setkey_ids[row], self.setkey_ids[col]]
+        if cell_id < 0:
+            return None
+        return self.cell_alt_contents[cell_id] if alt else self.cell_contents[cell_id]
 
     def _sample_fitting_set(self, cross_sets, parallel_sets):
         """ Samples a new column (assuming cross_sets are the rows and parallel_sets the previous columns. Or the other way round) """
-        choice = list(self._get_allowed_sets(cross_sets, parallel_sets))
+        with self.stats.timer("allowed_sets"):
+            choice = list(self._get_allowed_sets(cross_sets, parallel_sets))
+        self.stats.record_candidates(len(choice))
         if len(choice) == 0:
             return None
 
@@ -324,7 +330,8 @@ class GameGenerator:
             # print("\n".join([str(catset) for catset in choice]))
 
         # Shuffle the sets (do complete shuffle because might iterate some of them afterwards)
-        choice = self._shuffle_setkeys(choice)
+        with self.stats.timer("shuffle"):
+            choice = self._shuffle_setkeys(choice)
         
         # Iterate all possible sets randomly until a fitting one is hit
         for set1 in choice:
@@ -333,16 +340,68 @@ class GameGenerator:
                 return set1
         return None
 
+    def _sample_game_setup_backtracking(self):
+        """ Depth-first search over the partial board (columns and rows added alternately), in random candidate order.
+        On a dead end, the last row or column is replaced by its next candidate instead of restarting the board,
+        until max_backtracks replacements are used up. """
+        rows, cols = [], []
+        self.tracker.reset()
+        self.stats.start_try()
+        budget = [self.max_backtracks]
+
+        def extend(step):
+            if step == 2 * self.field_size:
+                with self.stats.timer("constraint_check"):
+                    valid = self._check_constraints(rows, cols)
+                if not valid:
+                    for violation in self.tracker.violations():
+                        self.stats.reject(f"constraint:{violation}")
+                return valid
+            # Sample a new column, then a new row
+            new, cross, parallel, name = (cols, rows, cols, "column") if step % 2 == 0 else (rows, cols, rows, "row")
+            with self.stats.timer("allowed_sets"):
+                choice = list(self._get_allowed_sets(cross, parallel))
+            self.stats.record_candidates(len(choice))
+            if not choice:
+                self.stats.reject(f"no_{name}_{len(new) + 1}")
+                return False
+            with self.stats.timer("shuffle"):
+                choice = self._shuffle_setkeys(choice)
+            cross_ids = [self.setkey_ids[setkey] for setkey in cross]
+            for candidate in choice:
+                candidate = tuple(candidate)
+                self.tracker.add(self.setkey_ids[candidate], cross_ids)
+                new.append(candidate)
+                if extend(step + 1):
+                    return True
+                new.pop()
+                self.tracker.remove(self.setkey_ids[candidate], cross_ids)
+                if budget[0] == 0:
+                    return False
+                budget[0] -= 1
+                self.stats.reject(f"backtrack_{name}_{len(new) + 1}")
+            return False
+
+        if not extend(0):
+            return None, None
+        return rows, cols
+
     def _sample_game_setup(self):
+        if self.max_backtracks > 0:
+            return self._sample_game_setup_backtracking()
         rows, cols = [], []
+        self.tracker.reset()
+        self.stats.start_try()
         # print("--------------------------------------------------------------------------")
         for i in range(self.field_size):
             # Sample a new column, then a new row
             new_col = self._sample_fitting_set(rows, cols)
             if new_col is not None:
+                self.tracker.add(self.setkey_ids[new_col], [self.setkey_ids[row] for row in rows])
                 cols.append(new_col)
             else:
                 # print("Cancel")
+                self.stats.reject(f"no_column_{i + 1}")
                 return None, None
             
             # if i > 0:
@@ -350,60 +409,224 @@ class GameGenerator:
 
             new_row = self._sample_fitting_set(cols, rows)
             if new_row is not None:
+                self.tracker.add(self.setkey_ids[new_row], [self.setkey_ids[col] for col in cols])
                 rows.append(new_row)
             else:
                 # print("Cancel")
+                self.stats.reject(f"no_row_{i + 1}")
                 return None, None
             # print(len(rows) + len(cols), rows, cols)
         
         # Check constraints
-        if not all(c.apply(rows + cols) for c in self.constraints if isinstance(c, CategoryConstraint)):
-            return None, None
-        if not all(c.apply(self._cell_constraint_info(rows, cols)) for c in self.constraints if isinstance(c, CellConstraint)):
+        with self.stats.timer("constraint_check"):
+            valid = self._check_constraints(rows, cols)
+        if not valid:
+            for violation in self.tracker.violations():
+                self.stats.reject(f"constraint:{violation}")
             return None, None
         return rows, cols
 
+    def _check_constraints(self, rows, cols):
+        row_ids, col_ids = [self.setkey_ids[row] for row in rows], [self.setkey_ids[col] for col in cols]
+        if not self.tracker.in_sync(row_ids, col_ids):
+            self.tracker.rebuild(row_ids, col_ids)
+        return self.tracker.check()
 
-    def sample_game(self):
+
+    def _sample_shuffled_setup(self):
+        """ Samples a valid setup (rows, cols) and the number of tries it took. Returns (None, None, tries) on failure. """
         MAX_TRIES = 100
         rows, cols = None, None
+        self.stats.start_board()
         for i in range(MAX_TRIES):
             rows, cols = self._sample_game_setup()
             if rows is not None and cols is not None:
+                known = self._known_fingerprints if self._known_fingerprints is not None else self.dedup_index
+                if known is not None and fingerprint(rows, cols) in known:
+                    self.stats.reject("duplicate")
+                    rows, cols = None, None
+                    continue
                 break
         
         if rows is None or cols is None:
+            self.stats.finish_board(success=False)
             print(f"Error: Could not create game setup ({MAX_TRIES} tries)")
-            return None
+            return None, None, MAX_TRIES
+        self.stats.finish_board(success=True)
             
         if self.shuffle:
-            random.shuffle(rows)
-            random.shuffle(cols)
-            if random.random() > .5:
+            self.random.shuffle(rows)
+            self.random.shuffle(cols)
+            if self.random.random() > .5:
                 rows, cols = cols, rows
-        
+        return rows, cols, i
+
+    def _create_game(self, rows, cols, sample_tries=None):
         game = Game(solutions=[[self._get_solutions(row, col, alt=False) for col in cols] for row in rows],
                     alt_solutions=[[self._get_solutions(row, col, alt=True) for col in cols] for row in rows],
                     rows=[(self.categories[cat], value) for cat, value in rows],
                     cols=[(self.categories[cat], value) for cat, value in cols])
-        game.sample_tries = i
+        game.sample_tries = sample_tries
         return game
+
+    def sample_game(self):
+        rows, cols, tries = self._sample_shuffled_setup()
+        if rows is None or cols is None:
+            return None
+        if self.dedup_index is not None:
+            self.dedup_index.add(fingerprint(rows, cols))
+        return self._create_game(rows, cols, tries)
     
-    def sample_games(self, n=100, progress_bar=True):
+    def sample_games(self, n=100, progress_bar=True, workers=None):
+        """ Generates n games. With *workers* set, games are generated in chunks across a process pool.
+        Each chunk draws from its own random stream spawned from the seed, so the output only depends on the seed and
+        the call order (and not on the number of workers or the scheduling). """
         print(f"Generate {n} games...\n")
+        if workers is not None:
+            yield from self._sample_games_parallel(n, workers, progress_bar)
+            return
         
         iter = tqdm.tqdm(range(n), unit="games") if progress_bar else range(n)
         for _ in iter:
             game = self.sample_game()
             if game is None:
+                print(self.stats)
                 return []
             yield game
+
+    def _sample_games_parallel(self, n, workers, progress_bar):
+        # Chunks only skip the boards known before the run (in every process alike), so the output does not depend
+        # on the number of workers. Duplicates between chunks are dropped when merging, below.
+        if self.dedup_index is not None:
+            self._known_fingerprints = frozenset(self.dedup_index.fingerprints)
+
+        if workers <= 1:
+            pool = None
+            pool_map = lambda func, chunks: (func(chunk, self) for chunk in chunks)
+        else:
+            # Forked workers share the preprocessed data read-only instead of unpickling it. Where fork is not
+            # available (Windows), spawned workers receive a pickled copy of the generator once, at startup.
+            method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+            pool = multiprocessing.get_context(method).Pool(workers, initializer=_init_worker, initargs=(self,))
+            pool_map = pool.imap
+
+        random_state = self.random
+        remaining = n
+        try:
+            with tqdm.tqdm(total=n, unit="games", disable=not progress_bar) as pbar:
+                # Duplicates between chunks are dropped here and replaced by further chunks (with new random streams)
+                # until n games are generated. A round without any new game means the unknown boards are (nearly)
+                # exhausted, so generation stops, like the sequential path after MAX_TRIES.
+                while remaining > 0:
+                    chunk_sizes = [min(PARALLEL_CHUNK_SIZE, remaining - i) for i in range(0, remaining, PARALLEL_CHUNK_SIZE)]
+                    chunks = list(zip(self.seed_seq.spawn(len(chunk_sizes)), chunk_sizes))
+                    added = 0
+                    for setups, records in pool_map(_sample_setup_chunk, chunks):
+                        self.stats.merge(records)
+                        for rows, cols, tries in setups:
+                            if rows is None or cols is None:
+                                print(self.stats)
+                                return
+                            if self.dedup_index is not None and not self.dedup_index.add(fingerprint(rows, cols)):
+                                self.stats.reject_board("duplicate")
+                                continue
+                            remaining -= 1
+                            added += 1
+                            pbar.update(1)
+                            yield self._create_game(rows, cols, tries)
+                    if added == 0:
+                        print(f"Error: Could not create new game setups (only duplicates in {len(chunks)} chunks, {n - remaining} of {n} games)")
+                        print(self.stats)
+                        return
+        finally:
+            self.random = random_state
+            self._known_fingerprints = None
+            if pool is not None:
+                pool.terminate()
     
+    def sample_games_by_level(self, quotas, estimator=None, calibration_size=1000, max_boards=None, progress_bar=True, model=None):
+        """ Generates games until the quota of every difficulty level is met (quotas: DifficultyLevel -> number of games).
+        Every board is scored as it is sampled, against a fitted DifficultyModel: the given model (e.g. persisted from
+        the existing bank), or the estimator's calibrated model. An uncalibrated estimator is calibrated on
+        calibration_size boards first. Boards of levels whose quota is met are dropped without creating a game,
+        so topping up one level does not require generating and scoring a full batch.
+        Stops after max_boards boards (default: 100 per requested game). """
+        if model is None:
+            if estimator is None:
+                raise ValueError("sample_games_by_level requires a DifficultyEstimator or a fitted DifficultyModel")
+            if estimator.model is None:
+                setups = [self._sample_shuffled_setup()[:2] for _ in range(calibration_size)]
+                estimator.calibrate([(rows, cols) for rows, cols in setups if rows is not None])
+            model = estimator.model
+        remaining = {str(level): n for level, n in quotas.items() if n > 0}
+        total = sum(remaining.values())
+        max_boards = max_boards if max_boards is not None else 100 * total
+        print(f"Generate {total} games ({', '.join(f'{level}: {n}' for level, n in remaining.items())})...\n")
+
+        with tqdm.tqdm(total=total, unit="games", disable=not progress_bar) as pbar:
+            for _ in range(max_boards):
+                if not remaining:
+                    return
+                rows, cols, tries = self._sample_shuffled_setup()
+                if rows is None or cols is None:
+                    print(self.stats)
+                    return
+                info = model.score_setup(rows, cols)
+                level = str(info["level"])
+                if level not in remaining:
+                    self.stats.reject_board(f"quota_met:{level}")
+                    continue
+                if self.dedup_index is not None:
+                    self.dedup_index.add(fingerprint(rows, cols))
+                remaining[level] -= 1
+                if remaining[level] == 0:
+                    del remaining[level]
+                pbar.update(1)
+                game = self._create_game(rows, cols, tries)
+                game.data["max_cell_difficulty"] = info["max_cell_difficulty"]
+                game.data["avg_cell_difficulty"] = info["avg_cell_difficulty"]
+                game.data["difficulty_level"] = level
+                yield game
+        if remaining:
+            print(f"Warning: quotas not met after {max_boards} boards (missing {', '.join(f'{level}: {n}' for level, n in remaining.items())})")
+
     # Alias for sample_game()
     def generate_game(self):
         return self.sample_game()
     
     # Alias for sample_games()
-    def generate_games(self, n=100, progress_bar=True):
-        return self.sample_games(n=n, progress_bar=progress_bar)
+    def generate_games(self, n=100, progress_bar=True, workers=None):
+        return self.sample_games(n=n, progress_bar=progress_bar, workers=workers)
+
 
+# Default backtracking budget per try for boards larger than 3x3
+DEFAULT_MAX_BACKTRACKS = 5
+
+# Number of games generated per task (and per random stream) by GameGenerator.sample_games(workers=...)
+PARALLEL_CHUNK_SIZE = 50
+
+# GameGenerator of a worker process of GameGenerator.sample_games(workers=...), set by the pool initializer
+_worker_generator = None
+
+
+def _init_worker(generator):
+    global _worker_generator
+    _worker_generator = generator
+
+
+def _sample_setup_chunk(chunk, generator=None):
+    seed_seq, size = chunk
+    generator = generator if generator is not None else _worker_generator
+    generator.random = np.random.default_rng(seed_seq)
+    # The board records of a chunk are always kept, to be merged into the generator's stats
+    stats, generator.stats = generator.stats, GenerationStats(keep_boards=True)
+    setups = []
+    try:
+        for _ in range(size):
+            rows, cols, tries = generator._sample_shuffled_setup()
+            setups.append((rows, cols, tries))
+            if rows is None or cols is None:
+                break
+        return setups, generator.stats.boards
+    finally:
+        generator.stats = stats
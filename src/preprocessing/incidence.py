@@ -0,0 +1,38 @@
+import numpy as np
+
+
+class Incidence:
+    """ Incidence matrix of a collection of country sets.
+    Every set becomes one boolean row over a fixed (sorted) country index, so intersections are computed
+    with elementwise AND and all pairwise intersection sizes with a single matrix product. """
+
+    def __init__(self, countries, sets: dict):
+        # countries: iso codes spanning the index. sets: dict mapping a key (e.g. setkey) to its list of iso codes
+        self.countries = np.array(sorted(set(countries)), dtype=object)
+        self.country_index = {iso: i for i, iso in enumerate(self.countries)}
+        self.keys = list(sets.keys())
+        self.key_index = {key: i for i, key in enumerate(self.keys)}
+
+        self.matrix = np.zeros((len(self.keys), len(self.countries)), dtype=bool)
+        for i, members in enumerate(sets.values()):
+            self.matrix[i, [self.country_index[c] for c in members]] = True
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.key_index
+
+    def intersection_size_matrix(self) -> np.ndarray:
+        """ Sizes of all pairwise intersections, computed as one product of the incidence matrix with its transpose """
+        # float32 matrix products use BLAS and are exact for counts far beyond any number of countries
+        m = self.matrix.astype(np.float32)
+        return np.rint(m @ m.T).astype(np.int64)
+
+    def members(self, mask: np.ndarray) -> list:
+        """ Converts a boolean row over the country index back to a sorted list of iso codes """
+        return self.countries[mask].tolist()
+
+    def intersection(self, key1, key2) -> list:
+        i, j = self.key_index[key1], self.key_index[key2]
+        return self.members(self.matrix[i] & self.matrix[j])
@@ -1,19 +1,57 @@
 
 
+import os
 import json
+import pickle
+import hashlib
+import inspect
+import copy
+from collections import Counter
+from functools import partial
 import pandas as pd
 import numpy as np
-import itertools
 import datetime
 from game import *
 from generator import *
 from category import *
 from utils import *
-from typing import Optional
+from incidence import Incidence
+from enumerator import BoardEnumerator
+from bank import ShardedGameWriter, CompactGameWriter, GameIndexWriter, write_json_array
+from typing import List, Optional
 
 # Ensure we're running in the right directory
 chdir_this_file()
 
+def category_definitions():
+    """ Definitions of all categories (constructors, to be called with the country DataFrame) """
+    return [
+        partial(NominalCategory, key="continent", name="Continent", difficulty=1, col="continent"),
+        partial(NominalCategory, key="starting_letter", name="Starting letter", difficulty=1, col="name", extractor=lambda x: x[0].upper()),
+        partial(NominalCategory, key="ending_letter", name="Ending letter", difficulty=2, col="name", extractor=lambda x: x[-1].upper()),
+        partial(NominalCategory, key="capital_starting_letter", name="Capital starting letter", difficulty=1.5, col="capital", extractor=lambda x: x[0].upper()),
+        partial(NominalCategory, key="capital_ending_letter", name="Capital ending letter", difficulty=3, col="capital", extractor=lambda x: x[-1].upper()),
+        partial(MultiNominalCategory, key="flag_colors", name="Flag color", difficulty=1.5, col="flag_colors"),
+        partial(SimpleBooleanCategory, key="landlocked", name="Landlocked", difficulty=2, col="landlocked"),
+        partial(SimpleBooleanCategory, key="island", name="Island Nation", difficulty=1.5, col="island"),
+        # New as of 20231025
+        partial(TopNCategory, key="top_20_population", name="Top 20 Population", difficulty=1, col="population", n=20),
+        partial(BottomNCategory, key="bottom_20_population", name="Bottom 20 Population", difficulty=2, col="population", n=20),
+        partial(TopNCategory, key="top_20_area", name="Top 20 Area", difficulty=1.5, col="area_km2", n=20),
+        partial(BottomNCategory, key="bottom_20_area", name="Bottom 20 Area", difficulty=2, col="area_km2", n=20),
+        partial(GreaterThanCategory, key="elevation_sup5k", name="Mountain over 5000m", difficulty=2, col="max_elev", bound=5000, or_equal=True),
+        partial(LessThanCategory, key="elevation_sub1k", name="No mountains over 1000m", difficulty=2.5, col="max_elev", bound=1000, or_equal=False)
+    ]
+
+
+def fix_data_format(df: pd.DataFrame):
+    df["continent"].fillna("NA", inplace=True)  # North America fix
+    df["iso"].fillna("NA", inplace=True)  # Namibia fix
+
+
+CACHE_DIR = ".cache/preprocessor"
+CACHED_ATTRIBUTES = ["categories", "setkeys", "incidence", "alt_incidence", "cells", "cell_info"]
+
 
 class Preprocessor:
     def __init__(self,
@@ -21,18 +59,24 @@ class Preprocessor:
                  language: str = "EN",
                  field_size: int = 3,
                  min_cell_size: int = 1,
-                 max_cell_size: Optional[int] = None):
+                 max_cell_size: Optional[int] = None,
+                 categories: Optional[List[str]] = None,
+                 cache_dir: Optional[str] = CACHE_DIR,
+                 shared_categories: Optional[dict] = None,
+                 shared_cells: Optional[dict] = None):
 
         self.df = countries
         self.language = language
         self.field_size = field_size
         self.min_cell_size = max(1, min_cell_size)
         self.max_cell_size = max_cell_size
+        self.shared_categories = shared_categories or {}  # key -> Category computed once for several Preprocessors (see MultiLanguagePreprocessor)
+        self.shared_cells = shared_cells if shared_cells is not None else {}  # (row, col) -> (members, cell) of cells of two shared categories
+        self._value_sources = {}  # see value_sources()
         
         # ------------------------------------------------------------------------------------------------------------------
         # Fix data format
-        self.df["continent"].fillna("NA", inplace=True)  # North America fix
-        self.df["iso"].fillna("NA", inplace=True)  # Namibia fix
+        fix_data_format(self.df)
         # altcols = [col for col in self.df.columns if col.endswith("_alt")]
         # listcols = altcols + ["neighbors", "terrritories", "languages", "flag_colors"]
         # list_cols = [col for col in self.df.columns if self.df[col].apply(lambda s: isinstance(s, str) and s.startswith("[") and s.endswith("]")).all()]
@@ -42,108 +86,69 @@ class Preprocessor:
         # ------------------------------------------------------------------------------------------------------------------
         # Categories
 
-        self.categories = [
-            NominalCategory(self.df, key="continent", name="Continent", difficulty=1, col="continent"),
-            NominalCategory(self.df, key="starting_letter", name="Starting letter", difficulty=1, col="name", extractor=lambda x: x[0].upper()),
-            NominalCategory(self.df, key="ending_letter", name="Ending letter", difficulty=2, col="name", extractor=lambda x: x[-1].upper()),
-            NominalCategory(self.df, key="capital_starting_letter", name="Capital starting letter", difficulty=1.5, col="capital", extractor=lambda x: x[0].upper()),
-            NominalCategory(self.df, key="capital_ending_letter", name="Capital ending letter", difficulty=3, col="capital", extractor=lambda x: x[-1].upper()),
-            MultiNominalCategory(self.df, key="flag_colors", name="Flag color", difficulty=1.5, col="flag_colors"),
-            SimpleBooleanCategory(self.df, key="landlocked", name="Landlocked", difficulty=2, col="landlocked"),
-            SimpleBooleanCategory(self.df, key="island", name="Island Nation", difficulty=1.5, col="island"),
-            # New as of 20231025
-            TopNCategory(self.df, key="top_20_population", name="Top 20 Population", difficulty=1, col="population", n=20),
-            BottomNCategory(self.df, key="bottom_20_population", name="Bottom 20 Population", difficulty=2, col="population", n=20),
-            TopNCategory(self.df, key="top_20_area", name="Top 20 Area", difficulty=1.5, col="area_km2", n=20),
-            BottomNCategory(self.df, key="bottom_20_area", name="Bottom 20 Area", difficulty=2, col="area_km2", n=20),
-            GreaterThanCategory(self.df, key="elevation_sup5k", name="Mountain over 5000m", difficulty=2, col="max_elev", bound=5000, or_equal=True),
-            LessThanCategory(self.df, key="elevation_sub1k", name="No mountains over 1000m", difficulty=2.5, col="max_elev", bound=1000, or_equal=False)
-        ]
-        self.categories = {cat.key: cat for cat in self.categories}
+        self.category_definitions = category_definitions()
+        # Restrict to a subset of categories (e.g. those a generator config uses). The other categories are not built.
+        if categories is not None:
+            unknown = set(categories).difference(define.keywords["key"] for define in self.category_definitions)
+            if unknown:
+                raise ValueError(f"Unknown categories: {', '.join(sorted(unknown))}")
+            self.category_definitions = [define for define in self.category_definitions if define.keywords["key"] in categories]
 
-        self.values = pd.concat([
-            self.df[["iso", "name"]],
-            pd.DataFrame({cat.key: cat.values for cat in self.categories.values()}),
-            pd.DataFrame({cat.alt_key: cat.alt_values for cat in self.categories.values() if cat.alt_values is not None}),
-        ], axis=1)
+        # Derived artifacts are cached on disk, keyed by a hash of all inputs (see cache_key)
+        self.cache_path = os.path.join(cache_dir, f"{self.cache_key()}.pkl") if cache_dir is not None else None
+        if self.cache_path is not None and os.path.exists(self.cache_path):
+            self.load_cache()
+        else:
+            self.build()
+            if self.cache_path is not None:
+                self.save_cache()
 
-        # ------------------------------------------------------------------------------------------------------------------
-        # Generate category value lists
+    def build(self):
+        self.categories = [self.init_category(define) for define in self.category_definitions]
+        self.categories = {cat.key: cat for cat in self.categories}
 
-        for cat in self.categories.values():
-            if isinstance(cat, NominalCategory):
-                cat.sets = self.values.groupby(by=cat.key)["iso"].agg(sorted)
-                cat.alt_sets = self.values.explode(column=cat.alt_key).groupby(by=cat.alt_key)["iso"].agg(sorted)
-            elif isinstance(cat, MultiNominalCategory):
-                cat.sets = self.values.explode(column=cat.key).groupby(by=cat.key)["iso"].agg(sorted)
-                cat.alt_sets = self.values.explode(column=cat.alt_key).groupby(by=cat.alt_key)["iso"].agg(sorted)
-            elif isinstance(cat, BooleanCategory):
-                # only consider True values. The False group does not yield a catset
-                cat.sets = self.values.groupby(by=cat.key)["iso"].agg(sorted)
-                cat.sets = cat.sets[cat.sets.index]
-                cat.alt_sets = self.values.explode(column=cat.alt_key).groupby(by=cat.alt_key)["iso"].agg(sorted)
-                cat.alt_sets = cat.alt_sets[cat.alt_sets.index]
-
-        # Filter out infrequent values (Retain only sets with at least 3 (FIELD_SIZE) elements)
-        while True:
-            num_sets_0 = sum(len(cat.sets) for cat in self.categories.values())
-            for cat in self.categories.values():
-                cat.sets = cat.sets[cat.sets.apply(len) >= self.field_size]
-            num_sets_1 = sum(len(cat.sets) for cat in self.categories.values())
-            if num_sets_0 != num_sets_1:
-                print(f"Removed {num_sets_0 - num_sets_1} category sets")
-            # Retain only countries contained in sets of at least 2 different categories (need matching row + column)
-            category_contents = {cat.key: cat.sets.sum() for cat in self.categories.values()}
-            # {cat: len(cc) for cat, cc in category_contents.items()}
-            contents = set().union(*[set(cc) for cc in category_contents.values()])
-            print("contents:", len(contents))
-            retain = {c for c in contents if len([key for key, cc in category_contents.items() if c in cc]) >= 2}
-            print("retain:", len(retain))
-            remove = contents.difference(retain)
-            
-            for cat in self.categories.values():
-                cat.sets = cat.sets.apply(lambda cc: [c for c in cc if c in retain])
-            if not remove:
-                print("No countries to remove")
-                break
-            print(f"Removed {len(remove)} countries:", remove)
-            print("Repeat ...")
+        self.filter_sets()
 
         # ------------------------------------------------------------------------------------------------------------------
         # Init setkeys & cells
 
         self.setkeys = sum([[(cat.key, value) for value in cat.sets.index] for cat in self.categories.values()], [])
-        self.cells = {}
-        for (key1, value1), (key2, value2) in itertools.combinations(self.setkeys, 2):
-            if self.is_cell_allowed(key1, value1, key2, value2):
-                row, col = (key1, value1), (key2, value2)
-                if row < col:  # row has the lexicographically smaller (key, value) pair
-                    row, col = col, row
-                self.cells[(row, col)] = self.init_cell_contents(*row, *col)
 
-        print(f"Generated {len(self.setkeys)} sets and {len(self.cells)} cells")
+        # Bitset representation of all sets (and of all sets including alternative values) over the country index
+        self.incidence = Incidence(self.df["iso"], {(key, value): self.categories[key].sets[value] for key, value in self.setkeys})
+        self.alt_incidence = Incidence(self.df["iso"], {(key, value): self.categories[key].sets[value] + self.categories[key].alt_sets.get(value, [])
+                                                        for key, value in self.setkeys})
 
-        # Bring cells to DataFrame to do filtering (cell size etc.)
-        self.cell_info = pd.DataFrame([{"row_cat": row[0], "row_val": row[1],
-                                        "col_cat": col[0], "col_val": col[1],
-                                        "contents": contents,
-                                        "alt_contents": self.init_cell_contents(*row, *col, alt=True)}
-                                        for (row, col), contents in self.cells.items()])
-        self.cell_info["size"] = self.cell_info["contents"].apply(len)
+        # Candidate cells (upper triangle of the setkey x setkey matrix) and the number of solutions of every cell
+        candidates = np.triu(self.cell_allowed_mask(self.setkeys), k=1)
+        sizes = self.incidence.intersection_size_matrix()
+        print(f"Generated {len(self.setkeys)} sets and {candidates.sum()} cells")
 
         # ------------------------------------------------------------------------------------------------------------------
         # Filter cells w.r.t. number of solutions
-        
-        if self.min_cell_size is not None:
-            self.cell_info = self.cell_info[(self.cell_info["size"] >= self.min_cell_size)]
+        # Only the retained cells are converted back to lists of countries
+
+        keep = candidates & (sizes >= self.min_cell_size)
         if self.max_cell_size is not None:
-            self.cell_info = self.cell_info[(self.cell_info["size"] <= self.max_cell_size)]
-        cell_keys = self.cell_info.apply(lambda row: ((row["row_cat"], row["row_val"]), (row["col_cat"], row["col_val"])), axis=1)
-        self.cells = {key: (contents, alt_contents) for key, contents, alt_contents in zip(cell_keys,
-                                                                                           self.cell_info["contents"],
-                                                                                           self.cell_info["alt_contents"])}
+            keep &= sizes <= self.max_cell_size
+
+        self.cells = {}
+        for i, j in zip(*np.nonzero(keep)):
+            row, col = self.setkeys[i], self.setkeys[j]
+            if row < col:  # row has the lexicographically larger (key, value) pair
+                row, col = col, row
+            self.cells[(row, col)] = self.init_cell(row, col)
+
+        self.cell_info = pd.DataFrame([{"row_cat": row[0], "row_val": row[1],
+                                        "col_cat": col[0], "col_val": col[1],
+                                        "contents": contents,
+                                        "alt_contents": alt_contents,
+                                        "size": len(contents)}
+                                        for (row, col), (contents, alt_contents) in self.cells.items()],
+                                      columns=["row_cat", "row_val", "col_cat", "col_val", "contents", "alt_contents", "size"])
+
         setkeys_old = self.setkeys
-        self.setkeys = list(sorted(set(pd.concat([cell_keys.apply(lambda c: c[0]), cell_keys.apply(lambda c: c[1])]).tolist())))
+        self.setkeys = list(sorted({setkey for cell in self.cells for setkey in cell}))
 
         print(f"Retained {len(self.cells)} cells (of size {self.min_cell_size}-{self.max_cell_size})")
         if len(self.setkeys) < len(setkeys_old):
@@ -153,6 +158,112 @@ class Preprocessor:
         # plt.title("Distribution of cell sizes")
         # plt.show()
 
+    def filter_sets(self):
+        """ Removes sets and countries until a fixed point is reached:
+        - Retain only sets with at least FIELD_SIZE elements
+        - Retain only countries contained in sets of at least 2 different categories (need matching row + column)
+        Worklist algorithm: removing a set or country only updates the counts of the affected countries and sets. """
+        members = {(cat.key, value): set(cc) for cat in self.categories.values() for value, cc in cat.sets.items()}
+        country_sets = {}  # country -> setkeys containing it
+        country_cats = {}  # country -> {category key: number of its sets containing the country}
+        for (key, value), cc in members.items():
+            for c in cc:
+                country_sets.setdefault(c, []).append((key, value))
+                country_cats.setdefault(c, Counter())[key] += 1
+
+        removed_sets, removed_countries = set(), set()
+        set_queue = [setkey for setkey, cc in members.items() if len(cc) < self.field_size]
+        country_queue = [c for c, cats in country_cats.items() if len(cats) < 2]
+        while set_queue or country_queue:
+            while set_queue:
+                setkey = set_queue.pop()
+                if setkey in removed_sets:
+                    continue
+                removed_sets.add(setkey)
+                for c in members[setkey]:
+                    cats = country_cats[c]
+                    cats[setkey[0]] -= 1
+                    if cats[setkey[0]] == 0:
+                        del cats[setkey[0]]
+                        if len(cats) < 2:
+                            country_queue.append(c)
+            while country_queue:
+                c = country_queue.pop()
+                if c in removed_countries:
+                    continue
+                removed_countries.add(c)
+                for setkey in country_sets[c]:
+                    if setkey not in removed_sets:
+                        members[setkey].discard(c)
+                        if len(members[setkey]) < self.field_size:
+                            set_queue.append(setkey)
+
+        for cat in self.categories.values():
+            keep = [(cat.key, value) not in removed_sets for value in cat.sets.index]
+            cat.sets = cat.sets[keep].apply(lambda cc: [c for c in cc if c not in removed_countries])
+        print(f"Removed {len(removed_sets)} category sets")
+        print(f"Removed {len(removed_countries)} countries:", removed_countries if removed_countries else "-")
+
+    def init_category(self, define):
+        key = define.keywords["key"]
+        if key not in self.shared_categories:
+            return define(self.df)
+        # Shared category: its sets were computed once (on the shared instance), filter them on a copy of its own
+        return copy.copy(self.shared_categories[key])
+
+    @property
+    def values(self):
+        """ Values and alternative values of all categories per country """
+        return pd.concat([
+            self.df[["iso", "name"]],
+            pd.DataFrame({cat.key: cat.values for cat in self.categories.values()}),
+            pd.DataFrame({cat.alt_key: cat.alt_values for cat in self.categories.values() if cat.alt_values is not None}),
+        ], axis=1)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Cache
+
+    def cache_key(self):
+        """ Hash of the country data, the parameters and the category definitions (including the code they depend on) """
+        h = hashlib.sha256()
+        h.update(self.df.to_json(orient="split", default_handler=str).encode("utf-8"))
+        h.update(repr((self.language, self.field_size, self.min_cell_size, self.max_cell_size)).encode("utf-8"))
+        for define in self.category_definitions:
+            h.update(repr((define.func.__name__, sorted((key, code_signature(value) if callable(value) else value)
+                                                        for key, value in define.keywords.items()))).encode("utf-8"))
+        # Any change to the code computing the artifacts invalidates the cache as well
+        modules = {inspect.getmodule(define.func) for define in self.category_definitions} | {inspect.getmodule(Preprocessor), inspect.getmodule(Incidence)}
+        for path in sorted(module.__file__ for module in modules):
+            with open(path, mode="rb") as f:
+                h.update(f.read())
+        return h.hexdigest()[:32]
+
+    def save_cache(self):
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, mode="wb") as f:
+            pickle.dump({attr: getattr(self, attr) for attr in CACHED_ATTRIBUTES}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.cache_path)
+        print(f"Preprocessing cached to {self.cache_path}")
+
+    def load_cache(self):
+        with open(self.cache_path, mode="rb") as f:
+            data = pickle.load(f)
+        for attr, value in data.items():
+            setattr(self, attr, value)
+        for cat in self.categories.values():
+            cat.df = self.df
+        # Functions (e.g. extractors) are not pickled, restore them from the definitions
+        for define in self.category_definitions:
+            cat = self.categories[define.keywords["key"]]
+            for key, value in define.keywords.items():
+                if callable(value):
+                    setattr(cat, key, value)
+        print(f"Loaded preprocessing from cache {self.cache_path} ({len(self.setkeys)} sets, {len(self.cells)} cells)")
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Cells
+
     def is_cell_allowed(self, key1, value1, key2, value2):
         # TODO incompatible ComparisonCategories? (bottom n, top n of the same col)
         if key1 != key2:
@@ -161,17 +272,51 @@ class Preprocessor:
             return False
         cat = self.categories[key1]
         return isinstance(cat, MultiNominalCategory)
+
+    def cell_allowed_mask(self, setkeys):
+        """ Vectorized is_cell_allowed() for all pairs of the given setkeys (symmetric boolean matrix) """
+        keys = np.array([key for key, value in setkeys], dtype=object)
+        multi_nominal = np.array([isinstance(self.categories[key], MultiNominalCategory) for key in keys], dtype=bool)
+        same_key = keys[:, None] == keys[None, :]
+        allowed = ~same_key | multi_nominal[:, None]
+        np.fill_diagonal(allowed, False)
+        return allowed
     
+    def init_cell(self, row, col):
+        """ Contents and alternative contents of a cell. Cells of two shared categories are computed once
+        and reused by the other Preprocessors, as long as the (filtered) sets of row and col are the same. """
+        shared = row[0] in self.shared_categories and col[0] in self.shared_categories
+        if shared:
+            members = (self.categories[row[0]].sets[row[1]], self.categories[col[0]].sets[col[1]])
+            cached = self.shared_cells.get((row, col))
+            if cached is not None and cached[0] == members:
+                return cached[1]
+        cell = (self.init_cell_contents(*row, *col), self.init_cell_contents(*row, *col, alt=True))
+        if shared:
+            self.shared_cells[(row, col)] = (members, cell)
+        return cell
+
+    def value_sources(self, cat):
+        """ For a NominalCategory with extractor: country -> {extracted value: set of the (main or alternative) values of cat.col producing it}.
+        Computed once per category. """
+        if cat.key not in self._value_sources:
+            alt_values = self.df[cat.alt_col] if cat.alt_col in self.df.columns else [[]] * len(self.df)
+            sources = {}
+            for iso, value, alt in zip(self.df["iso"], self.df[cat.col], alt_values):
+                country_sources = sources.setdefault(iso, {})
+                for x in [value] + list(alt):
+                    country_sources.setdefault(cat.extractor(x), set()).add(x)
+            self._value_sources[cat.key] = sources
+        return self._value_sources[cat.key]
+
     def init_cell_contents(self, key1, value1, key2, value2, alt=False):
         cat1, cat2 = self.categories[key1], self.categories[key2]
-        contents = set(cat1.sets[value1]).intersection(cat2.sets[value2])
+        contents = self.incidence.intersection((key1, value1), (key2, value2))
         if not alt:
-            return sorted(contents)
+            return contents
         
         # Solutions caused by alternative values
-        all1 = set(cat1.sets[value1] + cat1.alt_sets.get(value1, []))
-        all2 = set(cat2.sets[value2] + cat2.alt_sets.get(value2, []))
-        alt_contents = all1.intersection(all2).difference(contents)
+        alt_contents = set(self.alt_incidence.intersection((key1, value1), (key2, value2))).difference(contents)
         if not alt_contents:
             return []
         
@@ -180,17 +325,11 @@ class Preprocessor:
         # Only implemented for NominalCategory, as is it using an extractor function
         if isinstance(cat1, NominalCategory) and isinstance(cat2, NominalCategory):
             if cat1.col == cat2.col and cat1.extractor and cat2.extractor:
-                col = cat1.col
-                altcol = cat1.alt_col
-                dfx = self.df[self.df["iso"].isin(alt_contents)][["iso", col, altcol]].copy()
-                dfx["values"] = dfx.apply(lambda row: [row[col]] + list(row[altcol]), axis=1)
-                dfx["src1"] = dfx["values"].apply(lambda xx: [x for x in xx if cat1.extractor(x) == value1])
-                dfx["src2"] = dfx["values"].apply(lambda xx: [x for x in xx if cat2.extractor(x) == value2])
-                dfx["keep"] = dfx.apply(lambda row: not set(row["src1"]).isdisjoint(row["src2"]), axis=1)
-                alt_contents = dfx[dfx["keep"]]["iso"].tolist()
+                sources1, sources2 = self.value_sources(cat1), self.value_sources(cat2)
+                alt_contents = [iso for iso in alt_contents
+                                if not sources1[iso].get(value1, set()).isdisjoint(sources2[iso].get(value2, set()))]
                 
         # print(f"{key1}/{value1} - {key2}/{value2}")
-        # display(dfx)
         # print(f"keep {alt_contents}")
         
         return sorted(set(alt_contents))
@@ -199,7 +338,7 @@ class Preprocessor:
     # Game creation interface
 
     """ Instantiates the GameGenerator class, providing it with all data from preprocessing and setting additional parameters. """
-    def get_generator(self, constraints, category_probs, seed=None, selection_mode="shuffle_categories", uniform=False, shuffle=True):
+    def get_generator(self, constraints, category_probs, seed=None, selection_mode="shuffle_categories", uniform=False, shuffle=True, dedup_index=None, max_backtracks=None, keep_board_stats=False):
         
         return GameGenerator(preprocessor=self,
                              category_probs=category_probs,
@@ -207,19 +346,95 @@ class Preprocessor:
                              seed=seed,
                              selection_mode=selection_mode,
                              uniform=uniform,
-                             shuffle=shuffle)
+                             shuffle=shuffle,
+                             dedup_index=dedup_index,
+                             max_backtracks=max_backtracks,
+                             keep_board_stats=keep_board_stats)
 
-    def save_games(self, games, name: str):
-        games = list(games)
+    """ Instantiates the BoardEnumerator class to count, stream or uniformly sample all valid game setups. """
+    def get_enumerator(self, constraints=[]):
+        return BoardEnumerator(preprocessor=self, constraints=constraints)
+
+    def save_games(self, games, name: str, data_dir: str = "../../public/data", format: str = "json", shard_size: int = 1000, by_level: bool = False, dedup_index=None):
+        """ Saves the categories and streams the games to the game bank.
+        format "json": one JSON array file. format "ndjson": directory of NDJSON shards of shard_size games plus a manifest
+        (with by_level, separate shards per difficulty level). format "compact": one file with shared setkey and cell tables.
+        format "index": memory-mappable fixed-width records (see GameIndex), saved to games-index/ as the game API cannot read it.
+        With dedup_index (the DedupIndex passed to the generator), the fingerprints of the saved games are persisted. """
+        if format not in ("json", "ndjson", "compact", "index"):
+            raise ValueError(f"Unknown game bank format '{format}'")
         timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
         info = [timestamp, name, self.language.lower()]
 
         # Save category info
-        path = f"../../public/data/categories/{self.language.lower()}/categories-{'-'.join(info)}.json"
-        json.dump({cat.key: cat.to_json() for cat in self.categories.values()}, open(path, mode="w", encoding="utf-8"))
+        path = f"{data_dir}/categories/{self.language.lower()}/categories-{'-'.join(info)}.json"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, mode="w", encoding="utf-8") as f:
+            json.dump({cat.key: cat.to_json() for cat in self.categories.values()}, f)
         print(f"{len(self.categories)} categories saved to {path}")
 
         # Save games
-        path = f"../../public/data/games/{self.language.lower()}/games-{'-'.join(info)}.json"
-        json.dump([game.to_json() for game in games], open(path, mode="w", encoding="utf-8"))
-        print(f"{len(games)} games saved to {path}")
+        path = f"{data_dir}/games/{self.language.lower()}/games-{'-'.join(info)}"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if format == "ndjson":
+            with ShardedGameWriter(path, shard_size=shard_size, by_level=by_level) as writer:
+                count = writer.write_all(games)
+            print(f"{count} games saved to {path} ({len(writer.shards)} shards)")
+        elif format == "index":
+            path = f"{data_dir}/games-index/{self.language.lower()}/games-{'-'.join(info)}"
+            with GameIndexWriter(path) as writer:
+                count = writer.write_all(games)
+            print(f"{count} games saved to {path} ({', '.join(f'{level}: {len(records)}' for level, records in writer.records.items() if records)})")
+        elif format == "compact":
+            path += ".json"
+            with CompactGameWriter(path) as writer:
+                count = writer.write_all(games)
+            print(f"{count} games saved to {path} ({len(writer.setkey_ids)} setkeys, {len(writer.cells)} cells)")
+        else:
+            path += ".json"
+            count = write_json_array(games, path)
+            print(f"{count} games saved to {path}")
+        if dedup_index is not None:
+            dedup_index.save()
+
+
+class MultiLanguagePreprocessor:
+    """ Preprocessing of several languages in one pass (countries: dict language -> country DataFrame).
+    Categories whose columns are identical in all languages (e.g. continent, flags, population) are language neutral.
+    Their values and sets, and the cells between them, are computed once and shared. Only the language specific
+    categories (names, capitals) and their cells are computed per language. """
+
+    def __init__(self, countries: dict, **kwargs):
+        self.languages = list(countries.keys())
+        for df in countries.values():
+            fix_data_format(df)
+
+        definitions = category_definitions()
+        if kwargs.get("categories") is not None:
+            definitions = [define for define in definitions if define.keywords["key"] in kwargs["categories"]]
+        self.neutral_categories = [define.keywords["key"] for define in definitions if self.is_language_neutral(define, countries)]
+        print(f"Language neutral categories: {', '.join(self.neutral_categories)}")
+
+        df = countries[self.languages[0]]
+        shared = {define.keywords["key"]: define(df) for define in definitions if define.keywords["key"] in self.neutral_categories}
+        shared_cells = {}
+        self.preprocessors = {}
+        for language in self.languages:
+            print(f"\nPreprocessing ({language})")
+            self.preprocessors[language] = Preprocessor(countries=countries[language], language=language,
+                                                        shared_categories=shared, shared_cells=shared_cells, **kwargs)
+
+    @staticmethod
+    def is_language_neutral(define, countries: dict) -> bool:
+        """ Whether the columns the category depends on (incl. alternative values) are the same for all languages """
+        dfs = list(countries.values())
+        col = define.keywords["col"]
+        cols = ["iso"] + [c for c in (col, col + "_alt") if c in dfs[0].columns]
+        return all(set(cols).issubset(df.columns) and df[cols].equals(dfs[0][cols]) for df in dfs[1:])
+
+    def __getitem__(self, language) -> Preprocessor:
+        return self.preprocessors[language]
+
+    def items(self):
+        return self.preprocessors.items()
+
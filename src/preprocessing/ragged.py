@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+
+
+class RaggedArray:
+    """ Groups of values of varying length (e.g. the difficulties of the countries of each set or cell),
+    stored as one flat value array plus group offsets. Statistics are computed for all groups at once. """
+
+    def __init__(self, values, offsets):
+        # values: flat array of all groups. offsets: start of every group plus the total length (len(groups) + 1)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.sizes = np.diff(self.offsets)
+        self.group_ids = np.repeat(np.arange(len(self.sizes)), self.sizes)  # group of every value
+
+    @staticmethod
+    def from_sizes(values, sizes):
+        return RaggedArray(values, np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]))
+
+    @staticmethod
+    def from_lists(lists):
+        lists = [np.asarray(x, dtype=np.float64) for x in lists]
+        return RaggedArray.from_sizes(np.concatenate(lists) if lists else [], [len(x) for x in lists])
+
+    @staticmethod
+    def from_mask(mask, values):
+        """ One group per row of the boolean matrix mask, holding the values of the columns set in that row """
+        mask = np.asarray(mask, dtype=bool)
+        rows, cols = np.nonzero(mask)
+        return RaggedArray.from_sizes(np.asarray(values)[cols], mask.sum(axis=1))
+
+    @staticmethod
+    def from_members(groups, attribute: dict):
+        """ One group per list of keys (e.g. iso codes), holding their attribute values. Keys without a value are left out. """
+        groups = [[attribute[key] for key in group if key in attribute] for group in groups]
+        return RaggedArray.from_sizes([x for group in groups for x in group], [len(group) for group in groups])
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Group statistics (NaN for empty groups)
+
+    def _reduce(self, ufunc):
+        result = np.full(len(self), np.nan)
+        nonempty = self.sizes > 0
+        if nonempty.any():
+            result[nonempty] = ufunc.reduceat(self.values, self.offsets[:-1][nonempty])
+        return result
+
+    def sum(self):
+        return np.bincount(self.group_ids, weights=self.values, minlength=len(self))
+
+    def mean(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sum() / self.sizes
+
+    def min(self):
+        return self._reduce(np.minimum)
+
+    def max(self):
+        return self._reduce(np.maximum)
+
+    def std(self):
+        """ Population standard deviation (as np.std) """
+        deviations = self.values - self.mean()[self.group_ids]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.sqrt(np.bincount(self.group_ids, weights=deviations ** 2, minlength=len(self)) / self.sizes)
+
+    def median(self):
+        """ Exact median (mean of the two middle values for groups of even size) """
+        order = np.lexsort((self.values, self.group_ids))
+        values = self.values[order]
+        result = np.full(len(self), np.nan)
+        nonempty = self.sizes > 0
+        starts, sizes = self.offsets[:-1][nonempty], self.sizes[nonempty]
+        result[nonempty] = (values[starts + (sizes - 1) // 2] + values[starts + sizes // 2]) / 2
+        return result
+
+    def stats(self) -> pd.DataFrame:
+        return pd.DataFrame({"size": self.sizes, "mean": self.mean(), "min": self.min(), "max": self.max(),
+                             "median": self.median(), "std": self.std()})
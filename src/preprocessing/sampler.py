@@ -0,0 +1,58 @@
+import numpy as np
+
+
+def weighted_permutation(weights: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """ Random order of the positions of *weights*, equivalent to repeatedly drawing without replacement
+    proportional to the weights. Positions with zero weight are never drawn and left out. """
+    weights = np.asarray(weights, dtype=np.float64)
+    # Exponential sort keys (Efraimidis-Spirakis): smaller key ~ drawn earlier
+    with np.errstate(divide="ignore"):
+        keys = rng.exponential(size=len(weights)) / weights
+    order = np.argsort(keys, kind="stable")
+    return order[weights[order] > 0]
+
+
+class SetkeySampler:
+    """ Shuffles integer setkey ids for the GameGenerator, using NumPy arrays only.
+
+    selection_mode "shuffle_setkeys": setkeys are drawn with weights (category prob divided by the category size).
+    selection_mode "shuffle_categories": categories are drawn with weights, setkeys are ordered uniformly within each category.
+    Setkeys of categories without weight are never drawn with "shuffle_setkeys". With "shuffle_categories", they are
+    placed after all weighted categories, in uniform order.
+    uniform: ignore the category probabilities (all setkeys / categories have the same weight).
+    precomputed: category sizes refer to all setkeys. Otherwise, only the setkeys passed to shuffle() are counted. """
+
+    def __init__(self, setkey_cats: np.ndarray, category_weights: np.ndarray, selection_mode="shuffle_categories", uniform=False, precomputed=True):
+        if selection_mode not in ("shuffle_setkeys", "shuffle_categories"):
+            raise ValueError(f"Unknown selection mode '{selection_mode}'")
+        self.setkey_cats = np.asarray(setkey_cats, dtype=np.int64)  # category index of each setkey id
+        self.category_weights = np.asarray(category_weights, dtype=np.float64)  # weight of each category index
+        self.selection_mode = selection_mode
+        self.uniform = uniform
+        self.precomputed = precomputed
+        if self.uniform:
+            self.category_weights = np.ones_like(self.category_weights)
+        self.setkey_weights = self._setkey_weights(np.arange(len(self.setkey_cats)))
+
+    def _setkey_weights(self, ids):
+        if self.uniform:
+            return np.ones(len(ids))
+        cats = self.setkey_cats[ids]
+        cat_size = np.bincount(cats, minlength=len(self.category_weights))
+        return self.category_weights[cats] / cat_size[cats]
+
+    def shuffle(self, ids, rng: np.random.Generator) -> np.ndarray:
+        ids = np.asarray(ids, dtype=np.int64)
+
+        if self.selection_mode == "shuffle_setkeys":  # DEPR: this leads to unprobable categories being selected almost *never* because the frequent categories have many values
+            weights = self.setkey_weights[ids] if self.precomputed else self._setkey_weights(ids)
+            return ids[weighted_permutation(weights, rng)]
+
+        # shuffle_categories: order the categories with weights, then the values uniformly within their category.
+        # Categories without weight share the last rank, so their values follow in uniform order.
+        cat_order = weighted_permutation(self.category_weights, rng)
+        cat_rank = np.full(len(self.category_weights), len(cat_order), dtype=np.int64)
+        cat_rank[cat_order] = np.arange(len(cat_order))
+        rank = cat_rank[self.setkey_cats[ids]]
+        rnd = rng.random(size=len(ids))
+        return ids[np.lexsort((rnd, rank))]
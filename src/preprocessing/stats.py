@@ -0,0 +1,121 @@
+import json
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+STAGES = ["allowed_sets", "shuffle", "constraint_check"]
+
+
+class GenerationStats:
+    """ Telemetry of a GameGenerator, per board and in aggregate:
+    time spent per stage, number of candidate setkeys at each step, restarts and rejection reasons. """
+
+    def __init__(self, keep_boards=True):
+        self.keep_boards = keep_boards  # keep the records of all boards (otherwise only the aggregate)
+        self.reset()
+
+    def reset(self):
+        self.boards = []
+        self.num_boards = 0
+        self.num_failed = 0
+        self.total_time = Counter()
+        self.total_rejections = Counter()
+        self.total_tries = 0
+        self.candidates_sum = Counter()  # step -> sum of candidate counts
+        self.candidates_num = Counter()  # step -> number of observations
+        self._board = None
+        self._board_start = None
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Recording
+
+    def start_board(self):
+        self._board = {"success": False, "tries": 0, "time": {stage: 0.0 for stage in STAGES}, "candidates": [], "rejections": {}}
+        self._board_start = time.perf_counter()
+
+    def start_try(self):
+        if self._board is None:
+            self.start_board()
+        self._board["tries"] += 1
+        self._board["candidates"].append([])
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self._board is not None:
+                self._board["time"][stage] = self._board["time"].get(stage, 0.0) + time.perf_counter() - start
+
+    def record_candidates(self, num):
+        """ Number of candidate setkeys left at the current step of the current try """
+        if self._board is not None and self._board["candidates"]:
+            self._board["candidates"][-1].append(int(num))
+
+    def reject(self, reason):
+        if self._board is not None:
+            self._board["rejections"][reason] = self._board["rejections"].get(reason, 0) + 1
+
+    def reject_board(self, reason):
+        """ Rejection of an already finished board (e.g. a duplicate found when merging parallel chunks) """
+        self.total_rejections[reason] += 1
+
+    def finish_board(self, success):
+        board, self._board = self._board, None
+        if board is None:
+            return
+        board["success"] = success
+        board["time"]["total"] = time.perf_counter() - self._board_start
+        self.add_record(board)
+
+    def add_record(self, board):
+        self.num_boards += 1
+        self.num_failed += not board["success"]
+        self.total_tries += board["tries"]
+        self.total_time.update(board["time"])
+        self.total_rejections.update(board["rejections"])
+        for candidates in board["candidates"]:
+            for step, num in enumerate(candidates):
+                self.candidates_sum[step] += num
+                self.candidates_num[step] += 1
+        if self.keep_boards:
+            self.boards.append(board)
+
+    def merge(self, records):
+        """ Adds board records collected elsewhere (e.g. by worker processes) """
+        for board in records:
+            self.add_record(board)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Export
+
+    def summary(self) -> dict:
+        n = max(self.num_boards, 1)
+        return {
+            "boards": self.num_boards,
+            "failed": self.num_failed,
+            "tries": self.total_tries,
+            "restarts": self.total_tries - self.num_boards,
+            "avg_tries": self.total_tries / n,
+            "time": dict(self.total_time),
+            "avg_time": {stage: t / n for stage, t in self.total_time.items()},
+            "avg_candidates": [self.candidates_sum[step] / self.candidates_num[step] for step in sorted(self.candidates_num)],
+            "rejections": dict(self.total_rejections.most_common()),
+        }
+
+    def to_json(self, include_boards=True) -> dict:
+        data = {"summary": self.summary()}
+        if include_boards and self.keep_boards:
+            data["boards"] = self.boards
+        return data
+
+    def save(self, path: str, include_boards=True):
+        with open(path, mode="w", encoding="utf-8") as f:
+            json.dump(self.to_json(include_boards=include_boards), f)
+
+    def __str__(self):
+        s = self.summary()
+        return (f"GenerationStats({s['boards']} boards, {s['failed']} failed, {s['restarts']} restarts, "
+                f"top rejections: {dict(list(s['rejections'].items())[:3])})")
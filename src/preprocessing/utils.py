@@ -75,6 +75,11 @@ def camel_case(s: str) -> str:
     return output[0].lower() + output[1:]
 
 
+def code_signature(func) -> str:
+    """ Stable description of a function's code (e.g. a lambda), used for hashing definitions """
+    code = func.__code__
+    return repr((code.co_code, code.co_consts, code.co_names))
+
 
 def chdir_this_file():
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -21,6 +21,21 @@ export function randomChoice<T>(arr: Array<T>): T | undefined {
   return arr[Math.floor(arr.length * Math.random())];
 }
 
+export function weightedChoice<T>(arr: Array<T>, weights: number[]): T | undefined {
+  const total = weights.reduce((a, b) => a + b, 0)
+  if (!arr.length || total <= 0) {
+    return undefined
+  }
+  let r = total * Math.random()
+  for (let i = 0; i < arr.length; i++) {
+    r -= weights[i]
+    if (r < 0) {
+      return arr[i]
+    }
+  }
+  return arr[arr.length - 1]
+}
+
 /**
  * localStorage.getItem() wrapper, using JSON encoding
  * @param key 